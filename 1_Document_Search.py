@@ -47,6 +47,7 @@ if check_yaml_population(config_file, required_keys):
         query = st.chat_input("What do you want to know")
 
         pdf_mapping = {entry[2]: entry[3] for entry in document_list}
+        pdf_mapping["All document stores"] = "all"
 
         # Create a dropdown menu
         selected_pdf_name = st.selectbox("Select a document", options=list(pdf_mapping.keys()))
@@ -67,35 +68,41 @@ if check_yaml_population(config_file, required_keys):
         if query:
             st.write(f"User: {query}")
 
-            with st.status("Answering query...", expanded=True) as status:
-                # Reranking strategy and setting K depending on it
-                st.write("Searching for results...")
-                if rank_strategy == "rerank":
-                    paragraph_id_list, cosine_results = rag_class.retrieve_documents(query, k * 4, selected_pdf_id)
-                else:
-                    paragraph_id_list, cosine_results = rag_class.retrieve_documents(query, k, selected_pdf_id)
-
-                # Getting sources
-                st.write("Searching for sources...")
-                sources_list = rag_class.get_paragraph_sources(paragraph_id_list)
-
-                # Reranking strategy
-                if rank_strategy == "rerank":
-                    st.write("Re-ranking sources...")
-                    sorted_sources = rag_class.rerank_sources(query, sources_list)
-                    sorted_sources = sorted_sources[:k]
-                    context_for_llm = "".join(sorted_sources)
-                else:
-                    sorted_sources = sources_list
-                    context_for_llm = "".join(sources_list)
-
-                # Send to LLM
-                st.write("Sending to AI...")
-                answer = rag_class.make_llm_request(query, context_for_llm)
-                status.update(label="Answer found!", state="complete", expanded=False)
-
-            with st.chat_message("assistant"):
-                st.write(answer)
+            # A close enough earlier question on the same store and settings is answered from the cache
+            cached = rag_class.lookup_answer(query, selected_pdf_id, k, rank_strategy)
+
+            if cached is not None:
+                answer, sorted_sources = cached
+                with st.chat_message("assistant"):
+                    st.markdown(answer)
+            else:
+                with st.status("Answering query...", expanded=True) as status:
+                    # Reranking strategy and setting K depending on it
+                    st.write("Searching for results...")
+                    search_k = k * 4 if rank_strategy == "rerank" else k
+                    if selected_pdf_id == "all":
+                        paragraph_id_list, cosine_results, sources_list = rag_class.retrieve_documents_multi(query, search_k, "all", return_sources=True)
+                    else:
+                        paragraph_id_list, cosine_results, sources_list = rag_class.retrieve_documents(query, search_k, selected_pdf_id, return_sources=True)
+
+                    # Reranking strategy
+                    if rank_strategy == "rerank":
+                        st.write("Re-ranking sources...")
+                        sorted_sources = rag_class.rerank_sources(query, sources_list, top_k=k)
+                        context_for_llm = rag_class.build_context(sorted_sources)
+                    else:
+                        sorted_sources = sources_list
+                        context_for_llm = rag_class.build_context(sources_list)
+
+                    # Send to LLM
+                    st.write("Sending to AI...")
+                    status.update(label="Sources found!", state="complete", expanded=False)
+
+                # Show the answer as the tokens arrive
+                with st.chat_message("assistant"):
+                    answer = st.write_stream(rag_class.stream_llm_request(query, context_for_llm))
+
+                rag_class.store_answer(query, selected_pdf_id, k, rank_strategy, answer, sorted_sources)
 
             for idx, item in enumerate(sorted_sources):
                 with st.expander(f"Source {idx + 1}"):
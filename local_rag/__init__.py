@@ -1 +1,11 @@
-from .main import LocalRag
+# LocalRag is imported on first use, so worker processes that only parse documents don't load the models or the
+# database drivers when they import the package
+def __getattr__(name):
+    if name == "LocalRag":
+        from .main import LocalRag
+        return LocalRag
+
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+
+
+__all__ = ["LocalRag"]
@@ -0,0 +1,138 @@
+from typing import Callable
+
+
+# Fewest shared words for two sources to be merged, so common short phrases don't join unrelated passages
+MIN_OVERLAP_WORDS = 8
+
+
+# Rough token count for when the tokenizer of the LLM isn't available, about four characters per token
+def estimate_tokens(text: str) -> int:
+    return (len(text) + 3) // 4
+
+
+# Length of the longest suffix of a that is a prefix of b, in words, using the KMP prefix function of b + a
+def _overlap(a: list, b: list) -> int:
+    sequence = b + [None] + a
+    prefix = [0] * len(sequence)
+    for x in range(1, len(sequence)):
+        length = prefix[x - 1]
+        while length and sequence[x] != sequence[length]:
+            length = prefix[length - 1]
+        if sequence[x] == sequence[length]:
+            length += 1
+        prefix[x] = length
+
+    return prefix[-1]
+
+
+def _contains(a: list, b: list) -> bool:
+    return f" {' '.join(b)} " in f" {' '.join(a)} "
+
+
+# Merge two word lists when one contains the other or they overlap, otherwise return None
+def _merge(a: list, b: list):
+    if len(a) >= len(b) and _contains(a, b):
+        return a
+    if len(b) > len(a) and _contains(b, a):
+        return b
+
+    overlap = _overlap(a, b)
+    if overlap >= MIN_OVERLAP_WORDS:
+        return a + b[overlap:]
+
+    overlap = _overlap(b, a)
+    if overlap >= MIN_OVERLAP_WORDS:
+        return b + a[overlap:]
+
+    return None
+
+
+class ContextBuilder:
+    """
+    ContextBuilder
+
+    Assembles the LLM context from ranked sources. Small-to-big windows of neighbouring sentences, and the overlapping
+    word chunks of the simple strategy, repeat most of their text, so sources that overlap or contain each other are
+    merged into one span and duplicates are dropped. The spans are then packed in rank order under a token budget, the
+    last one cut at a word boundary.
+
+    Attributes:
+        token_budget (int): The most tokens of context to send, 0 for no limit.
+        count_tokens (Callable): Counts the tokens of a text, estimate_tokens by default.
+        separator (str): Text placed between spans.
+
+    Methods:
+        merge(sources: list) -> list[str]:
+            Returns the merged spans, ordered by the best ranked source in each.
+        build(sources: list) -> str:
+            Returns the merged spans packed under the token budget.
+    """
+
+    def __init__(self, token_budget: int = 0, count_tokens: Callable = None, separator: str = "\n\n"):
+        self.token_budget = token_budget
+        self.count_tokens = count_tokens or estimate_tokens
+        self.separator = separator
+
+    @staticmethod
+    def merge(sources: list) -> list[str]:
+        spans = []
+        for source in sources:
+            words = source.split()
+            if not words:
+                continue
+
+            # Merging can make a span reach spans it didn't overlap before, so keep merging until nothing changes.
+            # The merged span takes the place of the best ranked span in it
+            position = len(spans)
+            x = 0
+            while x < len(spans):
+                merged = _merge(spans[x], words)
+                if merged is None:
+                    x += 1
+                    continue
+
+                words = merged
+                del spans[x]
+                position = min(position, x)
+                x = 0
+
+            spans.insert(position, words)
+
+        return [" ".join(span) for span in spans]
+
+    def _truncate(self, span: str, budget: int) -> str:
+        words = span.split()
+        low, high = 0, len(words)
+
+        # Longest prefix of whole words that fits the budget
+        while low < high:
+            middle = (low + high + 1) // 2
+            if self.count_tokens(" ".join(words[:middle])) <= budget:
+                low = middle
+            else:
+                high = middle - 1
+
+        return " ".join(words[:low])
+
+    def build(self, sources: list) -> str:
+        spans = self.merge(sources)
+        if self.token_budget <= 0:
+            return self.separator.join(spans)
+
+        packed = []
+        remaining = self.token_budget
+        for span in spans:
+            if packed:
+                remaining -= self.count_tokens(self.separator)
+
+            tokens = self.count_tokens(span)
+            if tokens > remaining:
+                span = self._truncate(span, remaining)
+                if span:
+                    packed.append(span)
+                break
+
+            packed.append(span)
+            remaining -= tokens
+
+        return self.separator.join(packed)
@@ -1,3 +1,8 @@
 from .vector_db import VectorDatabase
+from .local_vector_db import LocalVectorDatabase
+from .vector_backends import VECTOR_BACKENDS, get_vector_database
 from .document_db import DocumentDB
 from .doc_text_db import DocumentTextDB
+from .embedding_cache_db import EmbeddingCacheDB
+from .connection_pool import ConnectionPool, get_connection_pool, close_all_pools
+from .migrations import migrate, ensure_schema
@@ -0,0 +1,168 @@
+import atexit
+import threading
+import time
+from contextlib import contextmanager
+import psycopg2
+from psycopg2 import pool as pg_pool
+import vecs
+
+
+class ConnectionPool:
+    """
+    ConnectionPool
+
+    Thread-safe pool of psycopg2 connections shared by DocumentDB, DocumentTextDB and VectorDatabase. Callers block
+    while every connection is checked out instead of failing, and connections that have been idle for longer than
+    ping_interval seconds are health checked before being handed out again.
+
+    Methods:
+        connection() -> psycopg2.extensions.connection:
+            Context manager checking out a connection. Commits on success and rolls back on error.
+
+        cursor() -> psycopg2.extensions.cursor:
+            Context manager returning a cursor on a checked out connection.
+
+        close() -> None:
+            Closes every connection in the pool.
+    """
+
+    def __init__(self, min_size: int, max_size: int, timeout: float = 30, ping_interval: float = 30, **connect_kwargs):
+        self._pool = pg_pool.ThreadedConnectionPool(min_size, max_size, **connect_kwargs)
+        self._slots = threading.BoundedSemaphore(max_size)
+        self._timeout = timeout
+        self._ping_interval = ping_interval
+        self._last_used = {}
+        self.closed = False
+
+    @staticmethod
+    def _is_healthy(conn) -> bool:
+        if conn.closed:
+            return False
+
+        try:
+            with conn.cursor() as cursor:
+                cursor.execute("SELECT 1")
+            conn.rollback()
+            return True
+        except psycopg2.Error:
+            return False
+
+    def _checkout(self):
+        conn = self._pool.getconn()
+
+        # Only ping connections that sat idle long enough for the server or a proxy to drop them
+        idle_for = time.monotonic() - self._last_used.get(id(conn), 0)
+        if conn.closed or (idle_for > self._ping_interval and not self._is_healthy(conn)):
+            self._pool.putconn(conn, close=True)
+            conn = self._pool.getconn()
+
+        return conn
+
+    @contextmanager
+    def connection(self):
+        if self.closed:
+            raise psycopg2.InterfaceError("Connection pool is closed.")
+
+        if not self._slots.acquire(timeout=self._timeout):
+            raise psycopg2.OperationalError("Timed out waiting for a database connection.")
+
+        conn = None
+        try:
+            conn = self._checkout()
+            yield conn
+            conn.commit()
+        except Exception:
+            if conn is not None and not conn.closed:
+                conn.rollback()
+            raise
+        finally:
+            if conn is not None:
+                self._last_used[id(conn)] = time.monotonic()
+                self._pool.putconn(conn, close=bool(conn.closed))
+            self._slots.release()
+
+    @contextmanager
+    def cursor(self):
+        with self.connection() as conn:
+            with conn.cursor() as cursor:
+                yield cursor
+
+    def close(self) -> None:
+        if not self.closed:
+            self.closed = True
+            self._pool.closeall()
+
+
+_pools = {}
+_vecs_clients = {}
+_collections = {}
+_registry_lock = threading.Lock()
+
+
+# Return the pool for a database, creating it on first use
+def get_connection_pool(config: dict) -> ConnectionPool:
+    key = (config['host'], config['database_name'], config['user'], config['password'])
+
+    with _registry_lock:
+        connection_pool = _pools.get(key)
+        if connection_pool is None or connection_pool.closed:
+            connection_pool = ConnectionPool(
+                int(config.get('db_pool_min', 1)),
+                int(config.get('db_pool_max', 10)),
+                timeout=float(config.get('db_pool_timeout', 30)),
+                ping_interval=float(config.get('db_pool_ping_interval', 30)),
+                dbname=config['database_name'],
+                user=config['user'],
+                password=config['password'],
+                host=config['host']
+            )
+            _pools[key] = connection_pool
+
+    return connection_pool
+
+
+# Return the shared vecs client for a connection string
+def get_vecs_client(connection_string: str) -> vecs.Client:
+    with _registry_lock:
+        client = _vecs_clients.get(connection_string)
+        if client is None:
+            client = vecs.create_client(connection_string)
+            _vecs_clients[connection_string] = client
+
+    return client
+
+
+# Return a cached collection handle, creating the collection if needed
+def get_collection(connection_string: str, name: str, dimension: int) -> vecs.Collection:
+    key = (connection_string, name)
+    collection = _collections.get(key)
+
+    if collection is None:
+        client = get_vecs_client(connection_string)
+        collection = client.get_or_create_collection(name=name, dimension=dimension)
+        with _registry_lock:
+            _collections[key] = collection
+
+    return collection
+
+
+# Drop a cached collection handle after the collection is deleted
+def forget_collection(connection_string: str, name: str) -> None:
+    with _registry_lock:
+        _collections.pop((connection_string, name), None)
+
+
+# Close every pool and vecs client, registered to run at interpreter exit
+def close_all_pools() -> None:
+    with _registry_lock:
+        for connection_pool in _pools.values():
+            connection_pool.close()
+        _pools.clear()
+
+        for client in _vecs_clients.values():
+            client.disconnect()
+        _vecs_clients.clear()
+        _collections.clear()
+
+
+atexit.register(close_all_pools)
@@ -1,5 +1,7 @@
-import psycopg2
 import yaml
+from psycopg2.extras import execute_values
+from .connection_pool import get_connection_pool
+from .migrations import ensure_schema
 
 
 class DocumentTextDB:
@@ -11,54 +13,85 @@ class DocumentTextDB:
         self._user = data_loaded['user']
         self._password = data_loaded['password']
         self._host = data_loaded['host']
-        self._conn = None
-        self._create_database()
+        self._write_batch_size = int(data_loaded.get('db_write_batch_size', 5000))
+        self._sentence_window = int(data_loaded.get('sentence_window', 8))
+        self._pool = get_connection_pool(data_loaded)
+        ensure_schema(data_loaded)
 
-    # Connect to the database and return the connection
-    def _connect_db(self):
-        self._conn = psycopg2.connect(
-            dbname=self._database_name, 
-            user=self._user, 
-            password=self._password, 
-            host=self._host
-        )
-        return self._conn.cursor()
-
-    # Create the tables if needed
-    def _create_database(self) -> None:
-        cursor = self._connect_db()
-        cursor.execute('''CREATE TABLE IF NOT EXISTS {} (
-                    id SERIAL PRIMARY KEY,
-                    doc_name TEXT,
-                    doc_id TEXT,
-                    paragraph_id TEXT,
-                    paragraph TEXT
-                )'''.format(self._para_table))
-        self._conn.commit()
-        self._conn.close()
-
-    # Add a document to the database
+    # Add paragraphs to the database, multi-row inserts committed every write batch, existing paragraph ids are kept
     def add_bulk_documents(self, data_in: list) -> None:
-        cursor = self._connect_db()
-        cursor.executemany("INSERT INTO {} (doc_name, doc_id, paragraph_id, paragraph) VALUES (%s, %s, %s, %s)".format(self._para_table), data_in)
-        self._conn.commit()
-        self._conn.close()
+        for start in range(0, len(data_in), self._write_batch_size):
+            with self._pool.cursor() as cursor:
+                execute_values(cursor, "INSERT INTO {} (doc_name, doc_id, paragraph_id, paragraph) VALUES %s ON CONFLICT (paragraph_id) DO NOTHING".format(self._para_table),
+                               data_in[start:start + self._write_batch_size], page_size=1000)
+
+    # Add small-to-big sentences as (doc_name, doc_id, paragraph_id, sentence, source_id, position) rows, each
+    # sentence is stored once and its window is put together from its neighbours when it is fetched
+    def add_bulk_spans(self, data_in: list) -> None:
+        for start in range(0, len(data_in), self._write_batch_size):
+            rows = [(row[0], row[1], row[2], row[3], row[4], row[5], row[5] + 1)
+                    for row in data_in[start:start + self._write_batch_size]]
+            with self._pool.cursor() as cursor:
+                execute_values(cursor, "INSERT INTO {} (doc_name, doc_id, paragraph_id, paragraph, source_id, sentence_start, sentence_end) VALUES %s ON CONFLICT (paragraph_id) DO NOTHING".format(self._para_table),
+                               rows, page_size=1000)
 
     # Return all the documents
     def get_big_from_small(self, paragraph_id: str) -> str:
-        cursor = self._connect_db()
-        cursor.execute("SELECT * FROM {} WHERE paragraph_id = %s".format(self._para_table), (paragraph_id,))
-        result = cursor.fetchone()
+        return self.get_many([paragraph_id])[0]
+
+    # Return the paragraphs for a list of paragraph ids in one query, in the order requested. Sentence rows are
+    # widened to sentence_window sentences around their span, near the start or end of the text the window is moved
+    # inwards like the stored windows are
+    def get_many(self, paragraph_ids: list) -> list:
+        if not paragraph_ids:
+            return []
+
+        before = self._sentence_window // 2
+        after = self._sentence_window - before
+        with self._pool.cursor() as cursor:
+            cursor.execute('''SELECT CASE WHEN t.source_id IS NULL THEN t.paragraph ELSE (
+                                  SELECT string_agg(s.paragraph, ' ' ORDER BY s.sentence_start) FROM {0} s
+                                  WHERE s.source_id = t.source_id AND s.sentence_start >= w.lo AND s.sentence_start < w.hi
+                              ) END
+                              FROM unnest(%(ids)s::text[]) WITH ORDINALITY AS ids(paragraph_id, ord)
+                              JOIN {0} t ON t.paragraph_id = ids.paragraph_id
+                              CROSS JOIN LATERAL (
+                                  SELECT t.sentence_start - %(before)s AS lo, t.sentence_end - 1 + %(after)s AS hi,
+                                         (SELECT sentence_end FROM {0} WHERE source_id = t.source_id ORDER BY sentence_start DESC LIMIT 1) AS n
+                              ) b
+                              CROSS JOIN LATERAL (
+                                  SELECT CASE WHEN b.lo < 0 THEN 0 WHEN b.hi > b.n THEN GREATEST(0, b.n - (b.hi - b.lo)) ELSE b.lo END AS lo,
+                                         CASE WHEN b.lo < 0 THEN b.hi - b.lo WHEN b.hi > b.n THEN b.n ELSE b.hi END AS hi
+                              ) w
+                              ORDER BY ids.ord'''.format(self._para_table),
+                           {"ids": list(paragraph_ids), "before": before, "after": after})
+            result = cursor.fetchall()
+
+        return [row[0] for row in result]
+
+    # Full-text search over the paragraphs of the given documents, returns (paragraph_id, rank) best first
+    def lexical_search(self, query: str, doc_ids: list, k: int) -> list:
+        if not doc_ids:
+            return []
 
-        self._conn.close()
+        # Match any query term, ts_rank_cd favours paragraphs with more and closer matches. Exact identifiers such
+        # as part numbers and error codes keep their own lexeme, so they are found even when the embedding misses them
+        with self._pool.cursor() as cursor:
+            cursor.execute('''WITH q AS (
+                                SELECT NULLIF(replace(plainto_tsquery('english', %s)::text, '&', '|'), '')::tsquery AS query
+                              )
+                              SELECT t.paragraph_id, ts_rank_cd(t.paragraph_tsv, q.query) AS rank
+                              FROM {} t, q
+                              WHERE t.doc_id = ANY(%s) AND t.paragraph_tsv @@ q.query
+                              ORDER BY rank DESC
+                              LIMIT %s'''.format(self._para_table), (query, list(doc_ids), k))
+            result = cursor.fetchall()
 
-        return result[4]
+        return [(row[0], row[1]) for row in result]
 
     # Delete a document
     def delete_document(self, doc_id: str) -> None:
-        cursor = self._connect_db()
-        cursor.execute("DELETE FROM {} WHERE doc_id = %s".format(self._para_table), (doc_id,))
-        self._conn.commit()
-        self._conn.close()
+        with self._pool.cursor() as cursor:
+            cursor.execute("DELETE FROM {} WHERE doc_id = %s".format(self._para_table), (doc_id,))
 
 
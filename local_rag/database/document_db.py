@@ -1,5 +1,6 @@
-import psycopg2
 import yaml
+from .connection_pool import get_connection_pool
+from .migrations import ensure_schema
 
 
 class DocumentDB:
@@ -11,52 +12,41 @@ class DocumentDB:
         self._user = data_loaded['user']
         self._password = data_loaded['password']
         self._host = data_loaded['host']
-        self._conn = None
-        self._create_database()
-
-    # Connect to the database and return the connection
-    def _connect_db(self):
-        self._conn = psycopg2.connect(
-            dbname=self._database_name, 
-            user=self._user, 
-            password=self._password, 
-            host=self._host
-        )
-        return self._conn.cursor()
-
-    # Create the tables if needed
-    def _create_database(self) -> None:
-        cursor = self._connect_db()
-        cursor.execute('''CREATE TABLE IF NOT EXISTS {} (
-                    id SERIAL PRIMARY KEY,
-                    doc_name TEXT,
-                    doc_id TEXT,
-                    chunk_method TEXT
-                )'''.format(self._para_table))
-        self._conn.commit()
-        self._conn.close()
+        self._pool = get_connection_pool(data_loaded)
+        ensure_schema(data_loaded)
 
     # Add a document to the database
     def add_document(self, doc_name: str, doc_id: str, chunk_method: str) -> None:
-        cursor = self._connect_db()
-        cursor.execute("INSERT INTO {} (doc_name, doc_id, chunk_method) VALUES (%s, %s, %s)".format(self._para_table), (doc_name, doc_id, chunk_method))
-        self._conn.commit()
-        self._conn.close()
+        with self._pool.cursor() as cursor:
+            cursor.execute("INSERT INTO {} (doc_name, doc_id, chunk_method) VALUES (%s, %s, %s)".format(self._para_table), (doc_name, doc_id, chunk_method))
 
     # Return all the documents
     def get_docs(self) -> list:
-        cursor = self._connect_db()
-        cursor.execute("SELECT * FROM {}".format(self._para_table))
-        result = cursor.fetchall()
-        self._conn.close()
+        with self._pool.cursor() as cursor:
+            cursor.execute("SELECT * FROM {}".format(self._para_table))
+            result = cursor.fetchall()
+
+        return result
+
+    # Return the ids of every document store
+    def get_doc_ids(self) -> list:
+        with self._pool.cursor() as cursor:
+            cursor.execute("SELECT DISTINCT doc_id FROM {}".format(self._para_table))
+            result = cursor.fetchall()
+
+        return [row[0] for row in result]
+
+    # Return the doc_id and chunk method of a document store by name, None when there is no such store
+    def get_doc_by_name(self, doc_name: str):
+        with self._pool.cursor() as cursor:
+            cursor.execute("SELECT doc_id, chunk_method FROM {} WHERE doc_name = %s ORDER BY id LIMIT 1".format(self._para_table), (doc_name,))
+            result = cursor.fetchone()
 
         return result
 
     # Delete a document
     def delete_document(self, doc_id: str) -> None:
-        cursor = self._connect_db()
-        cursor.execute("DELETE FROM {} WHERE doc_id = %s".format(self._para_table), (doc_id,))
-        self._conn.commit()
-        self._conn.close()
+        with self._pool.cursor() as cursor:
+            cursor.execute("DELETE FROM {} WHERE doc_id = %s".format(self._para_table), (doc_id,))
 
 
@@ -0,0 +1,45 @@
+import numpy as np
+import yaml
+from psycopg2.extras import execute_values
+from .connection_pool import get_connection_pool
+from .migrations import ensure_schema
+
+
+class EmbeddingCacheDB:
+    def __init__(self, config_file):
+        with open(config_file, 'r') as stream:
+            data_loaded = yaml.safe_load(stream)
+        self._cache_table = data_loaded.get('embedding_cache_table', 'embedding_cache')
+        self._pool = get_connection_pool(data_loaded)
+        ensure_schema(data_loaded)
+
+    # Return the cached embeddings for the keys that are present
+    def get_many(self, cache_keys: list) -> dict:
+        if not cache_keys:
+            return {}
+
+        with self._pool.cursor() as cursor:
+            cursor.execute("SELECT cache_key, dtype, embedding FROM {} WHERE cache_key = ANY(%s)".format(self._cache_table),
+                           (list(cache_keys),))
+            result = cursor.fetchall()
+
+        return {row[0]: np.frombuffer(bytes(row[2]), dtype=row[1]) for row in result}
+
+    # Add embeddings as (cache_key, model_id, embedding) tuples, keeping entries that already exist
+    def add_many(self, entries: list) -> None:
+        if not entries:
+            return
+
+        data_in = []
+        for cache_key, model_id, embedding in entries:
+            embedding = np.asarray(embedding, dtype=np.float32)
+            data_in.append((cache_key, model_id, embedding.dtype.str, embedding.tobytes()))
+
+        with self._pool.cursor() as cursor:
+            execute_values(cursor, "INSERT INTO {} (cache_key, model_id, dtype, embedding) VALUES %s ON CONFLICT (cache_key) DO NOTHING".format(self._cache_table),
+                           data_in)
+
+    # Delete every cached embedding of a model
+    def clear_model(self, model_id: str) -> None:
+        with self._pool.cursor() as cursor:
+            cursor.execute("DELETE FROM {} WHERE model_id = %s".format(self._cache_table), (model_id,))
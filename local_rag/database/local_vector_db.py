@@ -0,0 +1,506 @@
+import os
+import json
+import shutil
+import string
+import secrets
+import threading
+import time
+import yaml
+import numpy as np
+from concurrent.futures import ThreadPoolExecutor
+
+
+# Rows scored per block in a flat search, bounds the float32 copy made of a float16 matrix
+_SEARCH_BLOCK = 65536
+
+# Open stores are shared by every LocalVectorDatabase in the process, keyed by their directory
+_stores = {}
+_stores_lock = threading.Lock()
+
+_index_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="local-index")
+_index_builds = {}
+_index_lock = threading.Lock()
+
+_CODE_DTYPES = {"float16": np.float16, "int8": np.int8, "binary": np.uint8}
+
+if hasattr(np, "bitwise_count"):
+    _popcount = np.bitwise_count
+else:
+    _POPCOUNT_TABLE = np.array([bin(x).count("1") for x in range(256)], dtype=np.uint8)
+
+    def _popcount(values: np.ndarray) -> np.ndarray:
+        return _POPCOUNT_TABLE[values]
+
+
+# Quantize unit vectors. int8 codes carry one scale per vector so every vector uses the full int8 range, binary codes
+# keep the sign bit of every dimension packed 8 to a byte and have no scale
+def _quantize(vectors: np.ndarray, quantization: str) -> tuple[np.ndarray, np.ndarray]:
+    if quantization == "binary":
+        return np.packbits(vectors > 0, axis=1), None
+
+    if quantization == "float16":
+        return vectors.astype(np.float16), np.ones(len(vectors), dtype=np.float32)
+
+    scales = np.maximum(np.abs(vectors).max(axis=1), 1e-12) / 127.0
+    codes = np.clip(np.rint(vectors / scales[:, None]), -127, 127).astype(np.int8)
+
+    return codes, scales.astype(np.float32)
+
+
+class _LocalStore:
+    """
+    One document store on disk: meta.json with the row count, vectors.bin with the unit-normalised vectors as a
+    row-major matrix, rows.jsonl with the id and metadata of every row and, for large stores, index.hnsw. A quantized
+    store also keeps codes.bin (and scales.bin for int8 and float16), the flat search scans the codes and only reads
+    the full precision rows of the candidates to rescore them.
+
+    Appends write the vectors and rows first and meta.json last, so the row count only covers complete rows and a
+    crash mid-append is cut off on the next write.
+    """
+
+    def __init__(self, path: str, dim: int, dtype: str, quantization: str = "none"):
+        self.path = path
+        self.dim = dim
+        self.dtype = np.dtype(dtype)
+        self.quantization = quantization
+        self.lock = threading.RLock()
+        self.count = 0
+        self.rows_bytes = 0
+        self.ids = []
+        self.metadata = []
+        self.paragraph_ids = set()
+        self.matrix = None
+        self.codes = None
+        self.scales = None
+        self.graph = None
+        self._meta_mtime = None
+        self.refresh()
+
+    def _file(self, name: str) -> str:
+        return os.path.join(self.path, name)
+
+    # Reload when another process appended to the store since it was last read
+    def refresh(self) -> None:
+        try:
+            meta_mtime = os.stat(self._file("meta.json")).st_mtime_ns
+        except FileNotFoundError:
+            return
+
+        if meta_mtime == self._meta_mtime:
+            return
+
+        with open(self._file("meta.json"), 'r') as file:
+            meta = json.load(file)
+        if meta["dim"] != self.dim:
+            raise ValueError(f"The local vector store {self.path} holds {meta['dim']} dimensional vectors, not {self.dim}.")
+
+        self.dtype = np.dtype(meta["dtype"])
+        self.quantization = meta.get("quantization", "none")
+        self.count = meta["count"]
+        self.rows_bytes = meta["rows_bytes"]
+        with open(self._file("rows.jsonl"), 'rb') as file:
+            rows = [json.loads(line) for line in file.read(self.rows_bytes).splitlines()]
+        self.ids = [row[0] for row in rows]
+        self.metadata = [row[1] for row in rows]
+        self.paragraph_ids = {row[1]["paragraph_id"] for row in rows}
+        self._map()
+        self.graph = None
+        self._meta_mtime = meta_mtime
+
+    def _map(self) -> None:
+        if self.count:
+            self.matrix = np.memmap(self._file("vectors.bin"), dtype=self.dtype, mode="r", shape=(self.count, self.dim))
+        else:
+            self.matrix = None
+
+        self.codes = None
+        self.scales = None
+        if self.count and self.quantization != "none":
+            width = (self.dim + 7) // 8 if self.quantization == "binary" else self.dim
+            self.codes = np.memmap(self._file("codes.bin"), dtype=_CODE_DTYPES[self.quantization], mode="r",
+                                   shape=(self.count, width))
+            if self.quantization != "binary":
+                self.scales = np.memmap(self._file("scales.bin"), dtype=np.float32, mode="r", shape=(self.count,))
+
+    def append(self, ids: list, vectors: np.ndarray, metadata: list) -> None:
+        os.makedirs(self.path, exist_ok=True)
+        vectors = vectors / np.maximum(np.linalg.norm(vectors, axis=1, keepdims=True), 1e-12)
+        rows = b"".join(json.dumps([vector_id, row_metadata]).encode("utf-8") + b"\n"
+                        for vector_id, row_metadata in zip(ids, metadata))
+
+        with self.lock:
+            self.refresh()
+            files = [("vectors.bin", self.count * self.dim * self.dtype.itemsize, vectors.astype(self.dtype).tobytes()),
+                     ("rows.jsonl", self.rows_bytes, rows)]
+            if self.quantization != "none":
+                codes, scales = _quantize(vectors, self.quantization)
+                files.append(("codes.bin", self.count * codes.shape[1] * codes.itemsize, codes.tobytes()))
+                if scales is not None:
+                    files.append(("scales.bin", self.count * 4, scales.tobytes()))
+
+            # Drop anything past the last complete append before writing
+            for name, size, data in files:
+                with open(self._file(name), 'ab') as file:
+                    file.truncate(size)
+                    file.write(data)
+                    file.flush()
+                    os.fsync(file.fileno())
+
+            start = self.count
+            self.count += len(ids)
+            self.rows_bytes += len(rows)
+            temp_path = self._file("meta.json.tmp")
+            with open(temp_path, 'w') as file:
+                json.dump({"dim": self.dim, "dtype": self.dtype.name, "quantization": self.quantization,
+                           "count": self.count, "rows_bytes": self.rows_bytes}, file)
+            os.replace(temp_path, self._file("meta.json"))
+            self._meta_mtime = os.stat(self._file("meta.json")).st_mtime_ns
+
+            self.ids.extend(ids)
+            self.metadata.extend(metadata)
+            self.paragraph_ids.update(row_metadata["paragraph_id"] for row_metadata in metadata)
+            self._map()
+
+            # Keep a loaded graph in step with the matrix, a graph on disk is extended the next time it is loaded
+            if self.graph is not None:
+                self._extend_graph(start)
+                self.graph.save_index(self._file("index.hnsw"))
+
+    def _extend_graph(self, start: int) -> None:
+        if self.graph.get_max_elements() < self.count:
+            self.graph.resize_index(max(self.count, 2 * self.graph.get_max_elements()))
+
+        for block_start in range(start, self.count, _SEARCH_BLOCK):
+            block = np.asarray(self.matrix[block_start:block_start + _SEARCH_BLOCK], dtype=np.float32)
+            self.graph.add_items(block, np.arange(block_start, block_start + len(block)))
+
+    def load_graph(self, ef_search: int) -> bool:
+        if self.graph is not None:
+            return True
+
+        if not os.path.isfile(self._file("index.hnsw")):
+            return False
+
+        hnswlib = _import_hnswlib()
+        graph = hnswlib.Index(space="cosine", dim=self.dim)
+        graph.load_index(self._file("index.hnsw"), max_elements=max(self.count, 1))
+        graph.set_ef(ef_search)
+        self.graph = graph
+
+        # Rows appended by another process after the graph was saved
+        if graph.get_current_count() < self.count:
+            self._extend_graph(graph.get_current_count())
+            self.graph.save_index(self._file("index.hnsw"))
+
+        return True
+
+    def build_graph(self, m: int, ef_construction: int, ef_search: int) -> None:
+        hnswlib = _import_hnswlib()
+        with self.lock:
+            self.refresh()
+            graph = hnswlib.Index(space="cosine", dim=self.dim)
+            graph.init_index(max_elements=max(self.count, 1), ef_construction=ef_construction, M=m)
+            graph.set_ef(ef_search)
+            self.graph = graph
+            self._extend_graph(0)
+            graph.save_index(self._file("index.hnsw"))
+
+    # Return (row, cosine distance) pairs for the k closest rows, closest first
+    def flat_search(self, query: np.ndarray, k: int, oversample: int = 4) -> list:
+        if self.quantization == "none":
+            return self.exact_search(query, k)
+
+        # Shortlist on the codes, then rescore the shortlist exactly
+        candidates = min(self.count, k * oversample)
+        if self.quantization == "binary":
+            rows = self._hamming_scan(self.codes, np.packbits(query > 0), candidates)
+        else:
+            rows, _ = self._scan(self.codes, self.scales, query, candidates)
+        rows = np.sort(rows)
+        scores = np.asarray(self.matrix[rows], dtype=np.float32) @ query
+
+        order = np.argsort(-scores, kind="stable")[:k]
+
+        return [(int(rows[x]), float(1.0 - scores[x])) for x in order]
+
+    @staticmethod
+    def _scan(matrix: np.ndarray, scales: np.ndarray, query: np.ndarray, k: int) -> tuple[np.ndarray, np.ndarray]:
+        rows = []
+        scores = []
+        for start in range(0, len(matrix), _SEARCH_BLOCK):
+            block_scores = np.asarray(matrix[start:start + _SEARCH_BLOCK], dtype=np.float32) @ query
+            if scales is not None:
+                block_scores *= scales[start:start + _SEARCH_BLOCK]
+            if len(block_scores) > k:
+                top = np.argpartition(-block_scores, k - 1)[:k]
+            else:
+                top = np.arange(len(block_scores))
+            rows.append(top + start)
+            scores.append(block_scores[top])
+
+        return np.concatenate(rows), np.concatenate(scores)
+
+    # Return the rows of the k codes closest to the query code in Hamming distance
+    @staticmethod
+    def _hamming_scan(codes: np.ndarray, query_code: np.ndarray, k: int) -> np.ndarray:
+        rows = []
+        distances = []
+        for start in range(0, len(codes), _SEARCH_BLOCK):
+            block_distances = _popcount(np.bitwise_xor(codes[start:start + _SEARCH_BLOCK], query_code)).sum(axis=1, dtype=np.int32)
+            if len(block_distances) > k:
+                top = np.argpartition(block_distances, k - 1)[:k]
+            else:
+                top = np.arange(len(block_distances))
+            rows.append(top + start)
+            distances.append(block_distances[top])
+
+        rows = np.concatenate(rows)
+        distances = np.concatenate(distances)
+        if len(rows) > k:
+            rows = rows[np.argpartition(distances, k - 1)[:k]]
+
+        return rows
+
+    def exact_search(self, query: np.ndarray, k: int) -> list:
+        rows, scores = self._scan(self.matrix, None, query, k)
+        order = np.argsort(-scores, kind="stable")[:k]
+
+        return [(int(rows[x]), float(1.0 - scores[x])) for x in order]
+
+    def graph_search(self, query: np.ndarray, k: int) -> list:
+        labels, distances = self.graph.knn_query(query, k=k)
+
+        return [(int(row), float(distance)) for row, distance in zip(labels[0], distances[0])]
+
+
+def _import_hnswlib():
+    try:
+        import hnswlib
+    except ImportError as e:
+        raise ImportError("The local HNSW index needs hnswlib, install it with pip install hnswlib") from e
+
+    return hnswlib
+
+
+def _get_store(path: str, dim: int, dtype: str, quantization: str) -> _LocalStore:
+    with _stores_lock:
+        store = _stores.get(path)
+        if store is None:
+            store = _LocalStore(path, dim, dtype, quantization)
+            _stores[path] = store
+
+        return store
+
+
+class LocalVectorDatabase:
+    """
+    LocalVectorDatabase
+
+    In-process vector store with the same interface as VectorDatabase, for single user deployments that don't want a
+    network round trip per search. Each document store is a memory-mapped float32 or float16 matrix of unit vectors
+    with a sidecar file of ids and metadata, searched with a vectorised dot product. Stores with at least
+    local_hnsw_threshold vectors can build an in-process HNSW graph (needs hnswlib), smaller ones are always searched
+    exactly. With vector_quantization set, a new store also keeps float16 or int8 codes that the flat search scans
+    before rescoring the best k * rescore_oversample candidates on the full precision vectors.
+
+    Methods:
+        insert_batch_vecs(embedding, doc_id: str, paragraph_id_list: list) -> None:
+            Appends the vectors of a batch of paragraphs.
+        get_matches(vector_search: list, n_results: int) -> list:
+            Returns (id, cosine distance, metadata) tuples in the same order as VectorDatabase.get_matches.
+        ensure_cosine_index(background: bool = False) -> bool:
+            Builds the HNSW graph of a large store when it is missing.
+        delete_vecs() -> None:
+            Deletes the store from disk.
+    """
+
+    def __init__(self, config_file, db_table):
+        with open(config_file, 'r') as stream:
+            data_loaded = yaml.safe_load(stream)
+        self.db_table = db_table
+        self.vector_dim = data_loaded['vector_dim']
+        self.root_path = data_loaded.get('local_vector_path', 'local_vectors')
+        self.dtype = data_loaded.get('local_vector_dtype', 'float32')
+        self.hnsw_m = int(data_loaded.get('hnsw_m', 16))
+        self.hnsw_ef_construction = int(data_loaded.get('hnsw_ef_construction', 64))
+        self.hnsw_ef_search = int(data_loaded.get('local_hnsw_ef_search', 64))
+        self.hnsw_threshold = int(data_loaded.get('local_hnsw_threshold', 0))
+        self.id_scheme = data_loaded.get('id_scheme', 'random')
+        self.quantization = data_loaded.get('vector_quantization', 'none') or 'none'
+        if self.quantization == "binary":
+            self.rescore_oversample = int(data_loaded.get('binary_oversample', 16))
+        else:
+            self.rescore_oversample = int(data_loaded.get('rescore_oversample', 4))
+        if self.dtype not in ("float32", "float16"):
+            raise ValueError(f"Unknown local_vector_dtype {self.dtype}, choose float32 or float16.")
+        if self.quantization not in ("none", "float16", "int8", "binary"):
+            raise ValueError(f"Unknown vector_quantization {self.quantization}, choose none, float16, int8 or binary.")
+
+        self._path = os.path.join(self.root_path, db_table)
+
+    def _store(self) -> _LocalStore:
+        return _get_store(self._path, self.vector_dim, self.dtype, self.quantization)
+
+    @staticmethod
+    def _key_gen() -> str:
+        characters = string.ascii_letters + string.digits
+        key_id = ''.join(secrets.choice(characters) for _ in range(16))
+
+        return key_id
+
+    # Append vectors to the store, with content ids the paragraphs that are already stored are skipped
+    def insert_batch_vecs(self, embedding, doc_id: str, paragraph_id_list: list) -> None:
+        vectors = np.asarray(embedding, dtype=np.float32)
+        if vectors.ndim != 2 or vectors.shape[0] != len(paragraph_id_list):
+            raise ValueError("Invalid embedding. It should hold one vector per paragraph id.")
+
+        store = self._store()
+        with store.lock:
+            if self.id_scheme == "content":
+                store.refresh()
+                seen = set(store.paragraph_ids)
+                keep = []
+                for x, paragraph_id in enumerate(paragraph_id_list):
+                    if paragraph_id not in seen:
+                        seen.add(paragraph_id)
+                        keep.append(x)
+                vector_ids = [paragraph_id_list[x] for x in keep]
+                vectors = vectors[keep]
+            else:
+                keep = range(len(paragraph_id_list))
+                vector_ids = [self._key_gen() for _ in paragraph_id_list]
+
+            if not vector_ids:
+                return
+
+            metadata = [{"doc_id": doc_id, "paragraph_id": paragraph_id_list[x]} for x in keep]
+            store.append(vector_ids, vectors, metadata)
+
+    # Return the paragraph ids that already have a vector in this store
+    def existing_paragraph_ids(self, paragraph_id_list: list) -> set:
+        store = self._store()
+        with store.lock:
+            store.refresh()
+            return {paragraph_id for paragraph_id in paragraph_id_list if paragraph_id in store.paragraph_ids}
+
+    # Insert a vector into database
+    def insert_vec(self, embedding: list, doc_id: str, paragraph_id: str) -> None:
+        self.insert_batch_vecs([embedding], doc_id, [paragraph_id])
+
+    # Build the HNSW graph, replacing any existing one
+    def make_cosine_index(self) -> None:
+        self._store().build_graph(self.hnsw_m, self.hnsw_ef_construction, self.hnsw_ef_search)
+
+    # Small stores are searched exactly, so they count as indexed
+    def has_cosine_index(self) -> bool:
+        store = self._store()
+        with store.lock:
+            store.refresh()
+            if self.hnsw_threshold <= 0 or store.count < self.hnsw_threshold:
+                return True
+
+            return os.path.isfile(os.path.join(self._path, "index.hnsw"))
+
+    # Build state is shared by every instance for the same store, get_vector_database makes a new one per call
+    def _set_index_status(self, state: str, error: str = None) -> None:
+        with _index_lock:
+            _index_builds[self._path] = {"state": state, "updated_at": time.time(), "error": error}
+
+    def _build_index(self) -> None:
+        self._set_index_status("building")
+        try:
+            self.make_cosine_index()
+        except Exception as e:
+            self._set_index_status("failed", str(e))
+            raise
+        self._set_index_status("ready")
+
+    # Build the HNSW graph only when the store is large enough and has none, returns True when a build was started
+    def ensure_cosine_index(self, background: bool = False) -> bool:
+        # Claim the build under the lock so concurrent callers never queue a second one
+        with _index_lock:
+            status = _index_builds.get(self._path, {})
+            if status.get("state") in ("pending", "building") or self.has_cosine_index():
+                return False
+            _index_builds[self._path] = {"state": "pending", "updated_at": time.time(), "error": None}
+
+        if background:
+            _index_executor.submit(self._build_index)
+        else:
+            self._build_index()
+
+        return True
+
+    # Return the state and parameters of the index for this store
+    def index_status(self) -> dict:
+        with _index_lock:
+            status = dict(_index_builds.get(self._path, {}))
+        state = status.get("state") or ("ready" if self.has_cosine_index() else "missing")
+        graph = os.path.isfile(os.path.join(self._path, "index.hnsw"))
+
+        return {
+            "state": state,
+            "method": "hnsw" if graph else "flat",
+            "measure": "cosine_distance",
+            "m": self.hnsw_m,
+            "ef_construction": self.hnsw_ef_construction,
+            "updated_at": status.get("updated_at"),
+            "error": status.get("error"),
+        }
+
+    # Get the matches from the store using cosine similarity
+    def get_matches(self, vector_search: list, n_results: int) -> list:
+        store = self._store()
+        query = np.asarray(vector_search, dtype=np.float32).ravel()
+        query = query / max(float(np.linalg.norm(query)), 1e-12)
+
+        with store.lock:
+            store.refresh()
+            k = min(n_results, store.count)
+            if k <= 0:
+                return []
+
+            if self.hnsw_threshold > 0 and store.count >= self.hnsw_threshold and store.load_graph(self.hnsw_ef_search):
+                matches = store.graph_search(query, k)
+            else:
+                matches = store.flat_search(query, k, self.rescore_oversample)
+
+            results = [(store.ids[row], distance, store.metadata[row]) for row, distance in matches]
+
+        # Same order as VectorDatabase.get_matches
+        results = results[::-1]
+
+        return results
+
+    # Exact search over every vector, closest first, the reference for measuring the recall of get_matches
+    def exact_matches(self, vector_search: list, n_results: int) -> list:
+        store = self._store()
+        query = np.asarray(vector_search, dtype=np.float32).ravel()
+        query = query / max(float(np.linalg.norm(query)), 1e-12)
+
+        with store.lock:
+            store.refresh()
+            k = min(n_results, store.count)
+            if k <= 0:
+                return []
+
+            return [(store.ids[row], distance, store.metadata[row]) for row, distance in store.exact_search(query, k)]
+
+    # Return up to n stored vectors picked at random
+    def sample_vectors(self, n: int) -> np.ndarray:
+        store = self._store()
+        with store.lock:
+            store.refresh()
+            if not store.count:
+                return np.empty((0, self.vector_dim), dtype=np.float32)
+
+            rows = np.sort(np.random.default_rng().choice(store.count, size=min(n, store.count), replace=False))
+            return np.asarray(store.matrix[rows], dtype=np.float32)
+
+    # Delete the store
+    def delete_vecs(self) -> None:
+        with _stores_lock:
+            _stores.pop(self._path, None)
+        with _index_lock:
+            _index_builds.pop(self._path, None)
+        shutil.rmtree(self._path, ignore_errors=True)
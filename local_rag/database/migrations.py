@@ -0,0 +1,121 @@
+import threading
+from .connection_pool import get_connection_pool
+
+
+SCHEMA_VERSION_TABLE = "local_rag_schema_version"
+
+# Ordered schema migrations as (version, description, statements). The statements are formatted with the table
+# names from the config file, so deployments using their own table names are migrated in place as well.
+MIGRATIONS = [
+    (1, "Create the document and paragraph text tables", [
+        '''CREATE TABLE IF NOT EXISTS {paragraph_table} (
+            id SERIAL PRIMARY KEY,
+            doc_name TEXT,
+            doc_id TEXT,
+            chunk_method TEXT
+        )''',
+        '''CREATE TABLE IF NOT EXISTS {doc_text_table} (
+            id SERIAL PRIMARY KEY,
+            doc_name TEXT,
+            doc_id TEXT,
+            paragraph_id TEXT,
+            paragraph TEXT
+        )''',
+    ]),
+    (2, "Index paragraph ids and document ids", [
+        "CREATE UNIQUE INDEX IF NOT EXISTS {doc_text_table}_paragraph_id_idx ON {doc_text_table} (paragraph_id)",
+        "CREATE INDEX IF NOT EXISTS {doc_text_table}_doc_id_idx ON {doc_text_table} (doc_id)",
+        "CREATE INDEX IF NOT EXISTS {paragraph_table}_doc_id_idx ON {paragraph_table} (doc_id)",
+    ]),
+    (3, "Create the content-addressed chunk embedding cache", [
+        '''CREATE TABLE IF NOT EXISTS {embedding_cache_table} (
+            cache_key TEXT PRIMARY KEY,
+            model_id TEXT,
+            dtype TEXT,
+            embedding BYTEA,
+            created_at TIMESTAMPTZ NOT NULL DEFAULT now()
+        )''',
+    ]),
+    (4, "Add a full-text search column and GIN index to the paragraph text table", [
+        '''ALTER TABLE {doc_text_table} ADD COLUMN IF NOT EXISTS paragraph_tsv tsvector
+            GENERATED ALWAYS AS (to_tsvector('english', coalesce(paragraph, ''))) STORED''',
+        "CREATE INDEX IF NOT EXISTS {doc_text_table}_paragraph_tsv_idx ON {doc_text_table} USING GIN (paragraph_tsv)",
+    ]),
+    (5, "Add sentence spans so small-to-big text is stored once per sentence", [
+        '''ALTER TABLE {doc_text_table} ADD COLUMN IF NOT EXISTS source_id TEXT,
+            ADD COLUMN IF NOT EXISTS sentence_start INTEGER,
+            ADD COLUMN IF NOT EXISTS sentence_end INTEGER''',
+        "CREATE INDEX IF NOT EXISTS {doc_text_table}_source_span_idx ON {doc_text_table} (source_id, sentence_start)",
+    ]),
+]
+
+_checked_scopes = set()
+_checked_lock = threading.Lock()
+
+
+def _scope(config: dict) -> str:
+    return f"{config['paragraph_table']},{config['doc_text_table']}"
+
+
+def _create_version_table(cursor) -> None:
+    cursor.execute('''CREATE TABLE IF NOT EXISTS {} (
+                scope TEXT NOT NULL,
+                version INTEGER NOT NULL,
+                description TEXT,
+                applied_at TIMESTAMPTZ NOT NULL DEFAULT now(),
+                PRIMARY KEY (scope, version)
+            )'''.format(SCHEMA_VERSION_TABLE))
+
+
+# Return the latest applied schema version, 0 for a fresh database
+def current_version(config: dict) -> int:
+    with get_connection_pool(config).cursor() as cursor:
+        _create_version_table(cursor)
+        cursor.execute("SELECT COALESCE(MAX(version), 0) FROM {} WHERE scope = %s".format(SCHEMA_VERSION_TABLE),
+                       (_scope(config),))
+        return cursor.fetchone()[0]
+
+
+# Apply every pending migration in one transaction and return the versions applied
+def migrate(config: dict) -> list[int]:
+    scope = _scope(config)
+    tables = {
+        "paragraph_table": config['paragraph_table'],
+        "doc_text_table": config['doc_text_table'],
+        "embedding_cache_table": config.get('embedding_cache_table', 'embedding_cache')
+    }
+    applied = []
+
+    with get_connection_pool(config).cursor() as cursor:
+        _create_version_table(cursor)
+
+        # Serialise concurrent migrations of the same tables
+        cursor.execute("SELECT pg_advisory_xact_lock(hashtext(%s))", (SCHEMA_VERSION_TABLE + ":" + scope,))
+        cursor.execute("SELECT COALESCE(MAX(version), 0) FROM {} WHERE scope = %s".format(SCHEMA_VERSION_TABLE),
+                       (scope,))
+        version = cursor.fetchone()[0]
+
+        for migration_version, description, statements in MIGRATIONS:
+            if migration_version <= version:
+                continue
+
+            for statement in statements:
+                cursor.execute(statement.format(**tables))
+
+            cursor.execute("INSERT INTO {} (scope, version, description) VALUES (%s, %s, %s)".format(SCHEMA_VERSION_TABLE),
+                           (scope, migration_version, description))
+            applied.append(migration_version)
+
+    return applied
+
+
+# Migrate at most once per process, used by the database classes on construction
+def ensure_schema(config: dict) -> None:
+    scope = _scope(config)
+    if scope in _checked_scopes:
+        return
+
+    with _checked_lock:
+        if scope not in _checked_scopes:
+            migrate(config)
+            _checked_scopes.add(scope)
@@ -0,0 +1,21 @@
+import yaml
+from .vector_db import VectorDatabase
+from .local_vector_db import LocalVectorDatabase
+
+
+VECTOR_BACKENDS = {
+    "pgvector": VectorDatabase,
+    "local": LocalVectorDatabase,
+}
+
+
+# Return the vector store of a document store for the vector_backend in the config file
+def get_vector_database(config_file, db_table):
+    with open(config_file, 'r') as stream:
+        data_loaded = yaml.safe_load(stream)
+    backend = data_loaded.get('vector_backend', 'pgvector')
+
+    if backend not in VECTOR_BACKENDS:
+        raise ValueError(f"Unknown vector_backend {backend}, choose one of {', '.join(VECTOR_BACKENDS)}.")
+
+    return VECTOR_BACKENDS[backend](config_file, db_table)
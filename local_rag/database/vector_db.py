@@ -1,9 +1,16 @@
-import vecs
-from vecs import IndexMethod, IndexMeasure
+from vecs import IndexMethod, IndexMeasure, IndexArgsHNSW
 import yaml
 from pydantic import BaseModel
 import string
 import secrets
+import threading
+import time
+import io
+import json
+import struct
+import numpy as np
+from concurrent.futures import ThreadPoolExecutor
+from .connection_pool import get_connection_pool, get_vecs_client, get_collection, forget_collection
 
 
 # Vector database metadata model
@@ -12,6 +19,45 @@ class VectorMetadataModel(BaseModel):
 	paragraph_id: str
 
 
+# Index builds run one at a time in the background so a bulk load never competes with itself
+_index_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="vecs-index")
+_index_builds = {}
+_index_lock = threading.Lock()
+
+# Indexed expression, operator class, distance operator and query expression of the quantized search stage. pgvector
+# has no int8 vector type, so int8 indexes the vectors as halfvec like float16
+_QUANTIZED_INDEXES = {
+	"float16": ("vec::halfvec({dim})", "halfvec_cosine_ops", "<=>", "%s::halfvec({dim})"),
+	"int8": ("vec::halfvec({dim})", "halfvec_cosine_ops", "<=>", "%s::halfvec({dim})"),
+	"binary": ("binary_quantize(vec)::bit({dim})", "bit_hamming_ops", "<~>", "binary_quantize(%s::vector)::bit({dim})"),
+}
+
+# Binary COPY framing, see the COPY file format in the PostgreSQL docs
+_COPY_HEADER = b"PGCOPY\n\xff\r\n\x00" + struct.pack("!ii", 0, 0)
+_COPY_TRAILER = struct.pack("!h", -1)
+
+
+# Encode (id, vector, metadata) rows in COPY binary format, the vectors are written straight from the array buffer
+def _copy_vector_rows(vector_ids: list, vectors: np.ndarray, metadata: list) -> io.BytesIO:
+	dim = vectors.shape[1]
+	vector_header = struct.pack("!ihh", 4 + 4 * dim, dim, 0)
+	big_endian = np.ascontiguousarray(vectors, dtype=">f4")
+
+	parts = [_COPY_HEADER]
+	for vector_id, row, row_metadata in zip(vector_ids, big_endian, metadata):
+		id_bytes = vector_id.encode("utf-8")
+		metadata_bytes = b"\x01" + json.dumps(row_metadata).encode("utf-8")
+		parts.append(struct.pack("!hi", 3, len(id_bytes)))
+		parts.append(id_bytes)
+		parts.append(vector_header)
+		parts.append(row.tobytes())
+		parts.append(struct.pack("!i", len(metadata_bytes)))
+		parts.append(metadata_bytes)
+	parts.append(_COPY_TRAILER)
+
+	return io.BytesIO(b"".join(parts))
+
+
 class VectorDatabase:
 	def __init__(self, config_file, db_table):
 		with open(config_file, 'r') as stream:
@@ -23,12 +69,28 @@ class VectorDatabase:
 		self.db_password = data_loaded['password']
 		self.db_port = data_loaded['db_port']
 		self.vector_dim = data_loaded['vector_dim']
+		self.hnsw_m = int(data_loaded.get('hnsw_m', 16))
+		self.hnsw_ef_construction = int(data_loaded.get('hnsw_ef_construction', 64))
+		self.write_batch_size = int(data_loaded.get('db_write_batch_size', 5000))
+		self.id_scheme = data_loaded.get('id_scheme', 'random')
+		self.quantization = data_loaded.get('vector_quantization', 'none') or 'none'
+		if self.quantization == 'binary':
+			self.rescore_oversample = int(data_loaded.get('binary_oversample', 16))
+		else:
+			self.rescore_oversample = int(data_loaded.get('rescore_oversample', 4))
+		if self.quantization not in ('none', 'float16', 'int8', 'binary'):
+			raise ValueError(f"Unknown vector_quantization {self.quantization}, choose none, float16, int8 or binary.")
+		self._pool = get_connection_pool(data_loaded)
+		self._connection_string = f"postgresql://{self.db_user}:{self.db_password}@{self.db_host}:{int(self.db_port)}/{self.db_name}"
 		self._make_table()
 
 	# Make table if needed
 	def _make_table(self) -> None:
-		vx = vecs.create_client(f"postgresql://{self.db_user}:{self.db_password}@{self.db_host}:{int(self.db_port)}/{self.db_name}")
-		vx.disconnect()
+		get_vecs_client(self._connection_string)
+
+	# Return the shared collection handle
+	def _collection(self):
+		return get_collection(self._connection_string, self.db_table, self.vector_dim)
 
 	@staticmethod
 	def _key_gen() -> str:
@@ -37,43 +99,193 @@ class VectorDatabase:
 
 		return key_id
 
-	# Insert a vector into database
-	def insert_batch_vecs(self, embedding: list, doc_id: str, paragraph_id_list: list) -> None:
-		vx = vecs.create_client(f"postgresql://{self.db_user}:{self.db_password}@{self.db_host}:{int(self.db_port)}/{self.db_name}")
-		docs = vx.get_or_create_collection(name=self.db_table, dimension=self.vector_dim)
-		vectors = []
+	# Insert vectors into the database with binary COPY, committing every write_batch_size rows
+	def insert_batch_vecs(self, embedding, doc_id: str, paragraph_id_list: list) -> None:
+		# Make sure the collection exists before writing to its table
+		self._collection()
+		vectors = np.asarray(embedding, dtype=np.float32)
+		if vectors.ndim != 2 or vectors.shape[0] != len(paragraph_id_list):
+			raise ValueError("Invalid embedding. It should hold one vector per paragraph id.")
 
-		for idx, value in enumerate(zip(embedding, paragraph_id_list)):
-			vector_metadata = VectorMetadataModel(doc_id=doc_id, paragraph_id=value[1])
-			vectors.append((self._key_gen(), value[0], vector_metadata.model_dump()))
+		# Content ids are deterministic, so the paragraph id doubles as the vector id and re-inserts are skipped
+		if self.id_scheme == "content":
+			vector_ids = list(paragraph_id_list)
+			on_conflict = "DO NOTHING"
+		else:
+			vector_ids = [self._key_gen() for _ in paragraph_id_list]
+			on_conflict = "DO UPDATE SET vec = EXCLUDED.vec, metadata = EXCLUDED.metadata"
+		metadata = [{"doc_id": doc_id, "paragraph_id": paragraph_id} for paragraph_id in paragraph_id_list]
 
-		# Insert data
-		docs.upsert(records=vectors)
-		vx.disconnect()
+		for start in range(0, len(vector_ids), self.write_batch_size):
+			end = start + self.write_batch_size
+			rows = _copy_vector_rows(vector_ids[start:end], vectors[start:end], metadata[start:end])
+
+			# Stage the rows, then upsert them like vecs does
+			with self._pool.cursor() as cursor:
+				cursor.execute('CREATE TEMP TABLE vec_staging (LIKE vecs."{}") ON COMMIT DROP'.format(self.db_table))
+				cursor.copy_expert("COPY vec_staging (id, vec, metadata) FROM STDIN WITH (FORMAT binary)", rows)
+				cursor.execute('''INSERT INTO vecs."{}" (id, vec, metadata) SELECT id, vec, metadata FROM vec_staging
+								ON CONFLICT (id) {}'''.format(self.db_table, on_conflict))
+
+	# Return the paragraph ids that already have a vector in this collection
+	def existing_paragraph_ids(self, paragraph_id_list: list) -> set:
+		if not paragraph_id_list:
+			return set()
+
+		# With content ids the vector id is the paragraph id, so the primary key answers the lookup
+		if self.id_scheme == "content":
+			query = 'SELECT id FROM vecs."{}" WHERE id = ANY(%s)'
+		else:
+			query = "SELECT metadata->>'paragraph_id' FROM vecs.\"{}\" WHERE metadata->>'paragraph_id' = ANY(%s)"
+
+		self._collection()
+		with self._pool.cursor() as cursor:
+			cursor.execute(query.format(self.db_table), (list(paragraph_id_list),))
+			result = cursor.fetchall()
+
+		return {row[0] for row in result}
 
 	# Insert a vector into database
 	def insert_vec(self, embedding: list, doc_id: str, paragraph_id: str) -> None:
-		vx = vecs.create_client(f"postgresql://{self.db_user}:{self.db_password}@{self.db_host}:{int(self.db_port)}/{self.db_name}")
-		docs = vx.get_or_create_collection(name=self.db_table, dimension=self.vector_dim)
+		docs = self._collection()
 
 		# Validate metadata
 		vector_metadata = VectorMetadataModel(doc_id=doc_id, paragraph_id=paragraph_id)
 
 		# Insert data
 		docs.upsert(records=[(self._key_gen(), embedding, vector_metadata.model_dump())])
-		vx.disconnect()
 
-	# Index the vector database using cosine similarity
+	def _quantized_index_name(self) -> str:
+		return f"ix_{_QUANTIZED_INDEXES[self.quantization][1]}_hnsw_{self.db_table}"
+
+	# Index the vector database using cosine similarity, replacing any existing index
 	def make_cosine_index(self) -> None:
-		vx = vecs.create_client(f"postgresql://{self.db_user}:{self.db_password}@{self.db_host}:{int(self.db_port)}/{self.db_name}")
-		docs = vx.get_or_create_collection(name=self.db_table, dimension=self.vector_dim)
-		docs.create_index(method=IndexMethod.hnsw, measure=IndexMeasure.cosine_distance,)
-		vx.disconnect()
+		docs = self._collection()
+		if self.quantization != "none":
+			# Index a half precision or sign bit cast of the full precision column, get_matches rescores the candidates
+			expression, operator_class, _, _ = _QUANTIZED_INDEXES[self.quantization]
+			with self._pool.cursor() as cursor:
+				cursor.execute('DROP INDEX IF EXISTS vecs."{}"'.format(self._quantized_index_name()))
+				cursor.execute('''CREATE INDEX "{}" ON vecs."{}" USING hnsw (({}) {})
+								WITH (m = %s, ef_construction = %s)'''.format(self._quantized_index_name(), self.db_table,
+																			 expression.format(dim=self.vector_dim), operator_class),
+							   (self.hnsw_m, self.hnsw_ef_construction))
+			return
+
+		docs.create_index(
+			method=IndexMethod.hnsw,
+			measure=IndexMeasure.cosine_distance,
+			index_arguments=IndexArgsHNSW(m=self.hnsw_m, ef_construction=self.hnsw_ef_construction),
+		)
+
+	# Check for an existing HNSW cosine index, pgvector keeps it up to date on insert so it never needs a rebuild
+	def has_cosine_index(self) -> bool:
+		if self.quantization != "none":
+			self._collection()
+			with self._pool.cursor() as cursor:
+				cursor.execute("SELECT 1 FROM pg_indexes WHERE schemaname = 'vecs' AND tablename = %s AND indexname = %s",
+							   (self.db_table, self._quantized_index_name()))
+				return cursor.fetchone() is not None
+
+		index_name = self._collection().index
+		return index_name is not None and "hnsw" in index_name and "cosine" in index_name
+
+	def _index_status_entry(self, state: str, error: str = None) -> dict:
+		return {
+			"state": state,
+			"method": "hnsw",
+			"measure": "cosine_distance",
+			"m": self.hnsw_m,
+			"ef_construction": self.hnsw_ef_construction,
+			"quantization": self.quantization,
+			"updated_at": time.time(),
+			"error": error,
+		}
+
+	def _set_index_status(self, state: str, error: str = None) -> None:
+		with _index_lock:
+			_index_builds[(self._connection_string, self.db_table)] = self._index_status_entry(state, error)
+
+	def _build_index(self) -> None:
+		self._set_index_status("building")
+		try:
+			self.make_cosine_index()
+		except Exception as e:
+			self._set_index_status("failed", str(e))
+			raise
+		self._set_index_status("ready")
+
+	# Build the cosine index only when it is missing, returns True when a build was started
+	def ensure_cosine_index(self, background: bool = False) -> bool:
+		# Claim the build under the lock, a second build would replace the index again
+		key = (self._connection_string, self.db_table)
+		with _index_lock:
+			status = _index_builds.get(key, {})
+			if status.get("state") in ("pending", "building"):
+				return False
+
+			if self.has_cosine_index():
+				_index_builds[key] = self._index_status_entry("ready")
+				return False
+
+			_index_builds[key] = self._index_status_entry("pending")
+
+		if background:
+			_index_executor.submit(self._build_index)
+		else:
+			self._build_index()
+
+		return True
+
+	# Return the state and parameters of the index build for this collection
+	def index_status(self) -> dict:
+		with _index_lock:
+			status = _index_builds.get((self._connection_string, self.db_table))
+			if status is not None:
+				return dict(status)
+
+		return {
+			"state": "ready" if self.has_cosine_index() else "missing",
+			"method": "hnsw",
+			"measure": "cosine_distance",
+			"m": self.hnsw_m,
+			"ef_construction": self.hnsw_ef_construction,
+			"quantization": self.quantization,
+			"updated_at": None,
+			"error": None,
+		}
+
+	@staticmethod
+	def _vector_literal(vector_search) -> str:
+		return "[" + ",".join(str(float(value)) for value in np.asarray(vector_search, dtype=np.float32).ravel()) + "]"
+
+	# Search the quantized index for a larger candidate set, then rank the candidates on the full precision vectors
+	def _get_quantized_matches(self, vector_search: list, n_results: int) -> list:
+		self._collection()
+		candidates = n_results * self.rescore_oversample
+		query = self._vector_literal(vector_search)
+		expression, _, operator, query_expression = _QUANTIZED_INDEXES[self.quantization]
+
+		with self._pool.cursor() as cursor:
+			# The HNSW scan returns at most ef_search rows, which pgvector caps at 1000
+			cursor.execute("SET LOCAL hnsw.ef_search = %s", (min(1000, max(40, candidates)),))
+			cursor.execute('''SELECT c.id, c.vec <=> %s::vector AS distance, c.metadata
+							FROM (SELECT id, vec, metadata FROM vecs."{}"
+								ORDER BY {} {} {} LIMIT %s) c
+							ORDER BY distance LIMIT %s'''.format(self.db_table, expression.format(dim=self.vector_dim), operator,
+															  query_expression.format(dim=self.vector_dim)),
+						   (query, query, candidates, n_results))
+			results = [(row[0], row[1], row[2]) for row in cursor.fetchall()]
+
+		return results
 
 	# Get the matches from the vector database using cosine similarity
 	def get_matches(self, vector_search: list, n_results: int) -> list:
-		vx = vecs.create_client(f"postgresql://{self.db_user}:{self.db_password}@{self.db_host}:{int(self.db_port)}/{self.db_name}")
-		docs = vx.get_or_create_collection(name=self.db_table, dimension=self.vector_dim)
+		if self.quantization != "none":
+			# Same order as the vecs query below
+			return self._get_quantized_matches(vector_search, n_results)[::-1]
+
+		docs = self._collection()
 
 		# Pull the results
 		results = docs.query(
@@ -83,15 +295,35 @@ class VectorDatabase:
 			include_value=True,
 			include_metadata=True,
 		)
-		vx.disconnect()
 
 		# Organise in descending order on similarity
 		results = results[::-1]
 		
 		return results
 
+	# Exact search over every vector, closest first, the reference for measuring the recall of get_matches
+	def exact_matches(self, vector_search: list, n_results: int) -> list:
+		self._collection()
+		with self._pool.cursor() as cursor:
+			cursor.execute("SET LOCAL enable_indexscan = off")
+			cursor.execute("SET LOCAL enable_bitmapscan = off")
+			cursor.execute('''SELECT id, vec <=> %s::vector AS distance, metadata FROM vecs."{}"
+							ORDER BY distance LIMIT %s'''.format(self.db_table), (self._vector_literal(vector_search), n_results))
+			results = [(row[0], row[1], row[2]) for row in cursor.fetchall()]
+
+		return results
+
+	# Return up to n stored vectors picked at random
+	def sample_vectors(self, n: int) -> np.ndarray:
+		self._collection()
+		with self._pool.cursor() as cursor:
+			cursor.execute('SELECT vec::text FROM vecs."{}" ORDER BY random() LIMIT %s'.format(self.db_table), (n,))
+			result = cursor.fetchall()
+
+		return np.array([np.array(row[0].strip("[]").split(","), dtype=np.float32) for row in result])
+
 	# Delete a collection (table)
 	def delete_vecs(self) -> None:
-		vx = vecs.create_client(f"postgresql://{self.db_user}:{self.db_password}@{self.db_host}:{int(self.db_port)}/{self.db_name}")
+		vx = get_vecs_client(self._connection_string)
 		vx.delete_collection(self.db_table)
-		vx.disconnect()
+		forget_collection(self._connection_string, self.db_table)
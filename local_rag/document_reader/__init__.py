@@ -1 +1 @@
-from .document_reader import DocumentReader
\ No newline at end of file
+from .document_reader import DocumentReader, close_extraction_pools
\ No newline at end of file
@@ -1,12 +1,55 @@
 import PyPDF2
 import secrets
+import hashlib
+import multiprocessing
 import string
+import threading
 import nltk
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from typing import Iterator
 from nltk.tokenize import sent_tokenize
 from youtube_transcript_api import YouTubeTranscriptApi
 from docx import Document
 
 
+_extraction_pools = {}
+_extraction_pools_lock = threading.Lock()
+
+
+# Return the extraction pool for a worker count. It is kept alive across documents so its workers start once per
+# process, and spawned, not forked, as forking a process with loaded models and running threads can deadlock
+def _get_extraction_pool(workers: int) -> ProcessPoolExecutor:
+    with _extraction_pools_lock:
+        pool = _extraction_pools.get(workers)
+        if pool is None:
+            pool = ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context("spawn"))
+            _extraction_pools[workers] = pool
+
+    return pool
+
+
+# Shut down every extraction pool
+def close_extraction_pools() -> None:
+    with _extraction_pools_lock:
+        for pool in _extraction_pools.values():
+            pool.shutdown(cancel_futures=True)
+        _extraction_pools.clear()
+
+
+# Extract the text of a range of pdf pages, runs in a worker process
+def _extract_pdf_pages(file_name, start, end) -> list[str]:
+    with open(file_name, 'rb') as pdf_file:
+        pdf_reader_object = PyPDF2.PdfReader(pdf_file)
+        return [pdf_reader_object.pages[x].extract_text().replace("\n", " ") for x in range(start, end)]
+
+
+# Extract the text of a range of docx paragraphs, runs in a worker process
+def _extract_docx_paragraphs(file_name, start, end) -> list[str]:
+    doc = Document(file_name)
+    return [paragraph.text for paragraph in doc.paragraphs[start:end]]
+
+
 class DocumentReader:
     """
     DocumentReader
@@ -14,7 +57,12 @@ class DocumentReader:
     Class for reading and processing documents.
 
     Attributes:
-        None
+        extraction_workers (int): Worker processes used to extract pdf pages and docx paragraphs, 1 extracts in
+            process.
+        shard_pages (int): Pages (or 64 times as many docx paragraphs) extracted per worker task.
+        id_scheme (str): "random" paragraph keys, or "content" keys hashed from the store, position and text.
+        text_storage (str): "windows" to store the big string of every small-to-big chunk, or "spans" to store every
+            sentence once with its position, the window is then put together when it is fetched.
 
     Methods:
         _doc_key_gen() -> str:
@@ -23,6 +71,10 @@ class DocumentReader:
         _paragraph_key_gen() -> str:
             Generates a random key ID for a paragraph.
 
+        _content_key_gen(doc_id, position, text, big_string) -> str:
+            Generates a key ID for a paragraph from a hash of the document store, position and text, used when
+            id_scheme is "content" so re-ingesting the same document is idempotent.
+
         _split_text_into_chunks(self, text, chunk_size, overlap) -> tuple[list[str], list[str]]:
             Splits the text into chunks with a specified size and overlap.
 
@@ -35,18 +87,121 @@ class DocumentReader:
         _make_paragraph_list(page_chunks, doc_id) -> list[dict[str, str]]:
             Creates a list of paragraphs with a document ID.
 
-        load_pdf(self, file_name, chunk_strategy) -> tuple[list[dict[str, str]], list[str], str, list[str]]:
+        iter_pages(self, file_type, file_name) -> Iterator[str]:
+            Yields the text of a pdf, txt or docx file page by page (blocks of lines for txt, paragraphs for docx).
+
+        file_source_id(self, doc_id, file_name) -> str:
+            Returns the source id shared by the sentence spans of a file, hashed from the store and the file bytes
+            when id_scheme is "content".
+
+        iter_chunks(self, pages, chunk_strategy, chunk_size=300, overlap=50, doc_id=None, source_id=None) -> Iterator[tuple]:
+            Chunks a stream of pages and yields (text to embed, paragraph key, big string) as soon as each chunk is
+            complete, so documents can be ingested without holding their whole text. Small-to-big chunks stored as
+            spans get a fourth (source id, sentence position) element.
+
+        load_pdf(self, file_name, chunk_strategy, doc_id=None) -> tuple[list[dict[str, str]], list[str], str, list[str]]:
             Loads a PDF file, splits it into paragraphs, and returns the paragraphs, paragraph keys, document ID, and
             big string list.
 
-        load_txt(self, file_name, chunk_strategy) -> tuple[list[dict[str, str]], list[str], str, list[str]]:
+        load_txt(self, file_name, chunk_strategy, doc_id=None) -> tuple[list[dict[str, str]], list[str], str, list[str]]:
             Loads a TXT file, splits it into paragraphs, and returns the paragraphs, paragraph keys, document ID, and
             big string list.
 
-        load_docx(self, file_name, chunk_strategy) -> tuple[list[dict[str, str]], list[str], str, list[str]]:
+        load_docx(self, file_name, chunk_strategy, doc_id=None) -> tuple[list[dict[str, str]], list[str], str, list[str]]:
             Loads a DOCX file, splits it into paragraphs, and returns the paragraphs, paragraph keys, document ID, and
             big string list.
     """
+    def __init__(self, extraction_workers=1, shard_pages=16, id_scheme="random", text_storage="windows"):
+        if id_scheme not in ("random", "content"):
+            raise ValueError(f"Unknown id_scheme {id_scheme}, choose random or content.")
+
+        if text_storage not in ("windows", "spans"):
+            raise ValueError(f"Unknown text_storage {text_storage}, choose windows or spans.")
+
+        self.extraction_workers = extraction_workers
+        self.shard_pages = shard_pages
+        self.id_scheme = id_scheme
+        self.text_storage = text_storage
+
+    @staticmethod
+    def _content_key_gen(doc_id, position, text, big_string) -> str:
+        # Deterministic key, the same chunk at the same position of the same store always gets the same id
+        digest = hashlib.sha256(f"{doc_id}\0{position}\0{text}\0{big_string}".encode("utf-8")).hexdigest()
+
+        return digest[:32]
+
+    def _content_keys(self, doc_id, page_chunks, big_string_list, paragraph_keys) -> list[str]:
+        if self.id_scheme != "content":
+            return paragraph_keys
+
+        return [self._content_key_gen(doc_id, position, text, big_string)
+                for position, (text, big_string) in enumerate(zip(page_chunks, big_string_list))]
+
+    def _iter_content_keys(self, doc_id, chunks) -> Iterator[tuple[str, str, str]]:
+        for position, (text, paragraph_key, big_string) in enumerate(chunks):
+            yield text, self._content_key_gen(doc_id, position, text, big_string), big_string
+
+    # The sentences of one text share a source id. With content ids it is hashed from the store and the whole text,
+    # so two files never share one and a changed file gets a new one, otherwise it is random
+    def file_source_id(self, doc_id, file_name) -> str:
+        if self.id_scheme != "content":
+            return self._doc_key_gen()
+
+        digest = hashlib.sha256(f"{doc_id}\0".encode("utf-8"))
+        with open(file_name, 'rb') as file:
+            for block in iter(lambda: file.read(1 << 20), b""):
+                digest.update(block)
+
+        return digest.hexdigest()[:32]
+
+    def _text_source_id(self, doc_id, texts) -> str:
+        if self.id_scheme != "content":
+            return self._doc_key_gen()
+
+        digest = hashlib.sha256(f"{doc_id}\0".encode("utf-8"))
+        for text in texts:
+            digest.update(f"{text}\0".encode("utf-8"))
+
+        return digest.hexdigest()[:32]
+
+    # Return the paragraph keys and (source id, sentence position) spans of a whole text. Content keys are hashed from
+    # the source id, so the sentences of a changed file are all stored again under its new source id
+    def _sentence_spans(self, doc_id, page_chunks, big_string_list, paragraph_keys) -> tuple[list[str], list[tuple[str, int]]]:
+        source_id = self._text_source_id(doc_id, page_chunks)
+        paragraph_keys = self._content_keys(source_id, page_chunks, big_string_list, paragraph_keys)
+
+        return paragraph_keys, [(source_id, position) for position in range(len(paragraph_keys))]
+
+    @staticmethod
+    def _iter_sentence_spans(chunks, source_id) -> Iterator[tuple[str, str, str, tuple[str, int]]]:
+        for position, (text, paragraph_key, big_string) in enumerate(chunks):
+            yield text, paragraph_key, big_string, (source_id, position)
+
+    def _iter_sharded(self, extract_func, file_name, total, shard_size) -> Iterator[str]:
+        shards = [(start, min(start + shard_size, total)) for start in range(0, total, shard_size)]
+
+        # Keep a bounded number of shards in flight and yield them back in order
+        executor = _get_extraction_pool(self.extraction_workers)
+        in_flight = []
+        try:
+            for start, end in shards:
+                in_flight.append(executor.submit(extract_func, file_name, start, end))
+                if len(in_flight) >= 2 * self.extraction_workers:
+                    yield from in_flight.pop(0).result()
+
+            for future in in_flight:
+                yield from future.result()
+        except BrokenProcessPool:
+            # A worker died, the next document gets a new pool
+            with _extraction_pools_lock:
+                if _extraction_pools.get(self.extraction_workers) is executor:
+                    del _extraction_pools[self.extraction_workers]
+            raise
+        finally:
+            # Shards of an abandoned document don't hold up the next one
+            for future in in_flight:
+                future.cancel()
+
     @staticmethod
     def _doc_key_gen() -> str:
         characters = string.ascii_letters + string.digits
@@ -154,62 +309,219 @@ class DocumentReader:
 
         return paragraph_list
 
-    def load_pdf(self, file_name, chunk_strategy) -> tuple[list[dict[str, str]], list[str], str, list[str]]:
-        doc_id = self._doc_key_gen()
-
-        full_pdf_text = ""
-
+    def iter_pdf_pages(self, file_name) -> Iterator[str]:
         # Load the pdf with the filename
         with open(file_name, 'rb') as pdf_file:
             # Create a pdf reader object
             pdf_reader_object = PyPDF2.PdfReader(pdf_file)
+            num_pages = len(pdf_reader_object.pages)
 
-            # Loop through each page
-            for x in range(len(pdf_reader_object.pages)):
-                # Creat a page object
-                page_object = pdf_reader_object.pages[x]
+            if self.extraction_workers <= 1 or num_pages <= self.shard_pages:
+                # Loop through each page
+                for x in range(num_pages):
+                    # Remove multiple spacing for the page
+                    yield pdf_reader_object.pages[x].extract_text().replace("\n", " ")
+                return
 
-                # Remove multiple spacing for the page and split into chunks of 200 words
-                page = page_object.extract_text().replace("\n", " ")
+        # Extract page ranges across worker processes
+        yield from self._iter_sharded(_extract_pdf_pages, file_name, num_pages, self.shard_pages)
 
-                full_pdf_text = full_pdf_text + page
+    @staticmethod
+    def iter_txt_pages(file_name, block_size=65536) -> Iterator[str]:
+        # Read whole lines in blocks of roughly block_size characters
+        with open(file_name, 'r') as file:
+            block = []
+            block_length = 0
+            for line in file:
+                block.append(line)
+                block_length += len(line)
+                if block_length >= block_size:
+                    yield "".join(block)
+                    block = []
+                    block_length = 0
+
+            if block:
+                yield "".join(block)
+
+    def iter_docx_pages(self, file_name) -> Iterator[str]:
+        doc = Document(file_name)
+        num_paragraphs = len(doc.paragraphs)
+        shard_paragraphs = self.shard_pages * 64
+
+        if self.extraction_workers <= 1 or num_paragraphs <= shard_paragraphs:
+            for paragraph in doc.paragraphs:
+                yield paragraph.text
+            return
+
+        # Extract paragraph ranges across worker processes, each worker parses the file itself
+        del doc
+        yield from self._iter_sharded(_extract_docx_paragraphs, file_name, num_paragraphs, shard_paragraphs)
+
+    def iter_pages(self, file_type, file_name) -> Iterator[str]:
+        page_readers = {"pdf": self.iter_pdf_pages, "txt": self.iter_txt_pages, "docx": self.iter_docx_pages}
+        if file_type not in page_readers:
+            raise ValueError(f"Unsupported file type {file_type}, choose one of pdf, txt or docx.")
+
+        return page_readers[file_type](file_name)
+
+    def _iter_word_chunks(self, pages, chunk_size, overlap) -> Iterator[tuple[str, str, str]]:
+        # Fixed stride windows so a chunk can be emitted as soon as its words have been read
+        stride = chunk_size - overlap
+        words = []
+        emitted = False
+
+        for page in pages:
+            words.extend(page.split())
+            while len(words) >= chunk_size:
+                chunk = ' '.join(words[:chunk_size])
+                yield chunk, self._paragraph_key_gen(), chunk
+                emitted = True
+                del words[:stride]
+
+        # The first overlap words left are already in the last chunk, only emit the tail when it adds new words
+        if words and (not emitted or len(words) > overlap):
+            chunk = ' '.join(words)
+            yield chunk, self._paragraph_key_gen(), chunk
+
+    def _iter_sentence_windows(self, pages, sentences_chunk=8) -> Iterator[tuple[str, str, str]]:
+        nltk.download('punkt')
+        half = sentences_chunk // 2
+
+        # Sliding buffer of sentences, base is the position of buffer[0] in the document
+        buffer = []
+        base = 0
+        next_x = 0
+        count = 0
+
+        def window(start, end):
+            return " ".join(buffer[start - base: end - base])
+
+        def feed(sentences):
+            nonlocal base, next_x, count
+            buffer.extend(sentences)
+            count += len(sentences)
+
+            # Emit every sentence whose window is complete, matching _split_text_into_sentences
+            while next_x < count:
+                if next_x - half < 0:
+                    if count < sentences_chunk:
+                        break
+                    big_string = window(0, sentences_chunk)
+                elif next_x + half <= count:
+                    big_string = window(next_x - half, next_x + half)
+                else:
+                    break
+
+                yield buffer[next_x - base], self._paragraph_key_gen(), big_string
+                next_x += 1
+
+            # Keep the sentences still needed by pending windows and by the last window of the text
+            keep_from = max(0, min(next_x - half if next_x >= half else 0, count - sentences_chunk))
+            if keep_from > base:
+                del buffer[:keep_from - base]
+                base = keep_from
+
+        carry = ""
+        for page in pages:
+            sentences = sent_tokenize(carry + page)
+            if not sentences:
+                continue
+
+            # The last sentence may continue on the next page
+            carry = sentences[-1] + " "
+            yield from feed(sentences[:-1])
+
+        if carry.strip():
+            yield from feed([carry.strip()])
+
+        # Sentences near the end use the last window of the text
+        for x in range(next_x, count):
+            if x - half < 0:
+                big_string = window(0, sentences_chunk)
+            elif x + half <= count:
+                big_string = window(x - half, x + half)
+            elif count < sentences_chunk:
+                big_string = " ".join(buffer[count - sentences_chunk:])
+            else:
+                big_string = window(count - sentences_chunk, count)
+
+            yield buffer[x - base], self._paragraph_key_gen(), big_string
+
+    def iter_chunks(self, pages, chunk_strategy, chunk_size=300, overlap=50, doc_id=None, source_id=None) -> Iterator[tuple]:
+        if chunk_strategy == "simple":
+            chunks = self._iter_word_chunks(pages, chunk_size, overlap)
+        elif chunk_strategy == "smalltobig":
+            chunks = self._iter_sentence_windows(pages)
+        else:
+            raise ValueError(f"Unsupported chunk_strategy {chunk_strategy}.")
+
+        spans = chunk_strategy == "smalltobig" and self.text_storage == "spans"
+        if spans and source_id is None:
+            if self.id_scheme == "content":
+                raise ValueError("Sentence spans with content ids need the source_id of the file, see file_source_id.")
+            source_id = self._doc_key_gen()
+
+        if self.id_scheme == "content":
+            if doc_id is None:
+                raise ValueError("Content ids need the doc_id of the document store.")
+            chunks = self._iter_content_keys(source_id if spans else doc_id, chunks)
+
+        if spans:
+            chunks = self._iter_sentence_spans(chunks, source_id)
+
+        return chunks
+
+    def load_pdf(self, file_name, chunk_strategy, doc_id=None) -> tuple[list[dict[str, str]], list[str], str, list[str]]:
+        doc_id = doc_id or self._doc_key_gen()
+
+        # Join the pages once instead of concatenating page by page
+        full_pdf_text = "".join(self.iter_pdf_pages(file_name))
 
         page_chunks, paragraph_keys, big_string_list = self._text_splitter(full_pdf_text, chunk_strategy)
+        paragraph_keys = self._content_keys(doc_id, page_chunks, big_string_list, paragraph_keys)
         paragraph_list = self._make_paragraph_list(page_chunks, doc_id)
 
         return paragraph_list, paragraph_keys, doc_id, big_string_list
 
-    def load_txt(self, file_name, chunk_strategy) -> tuple[list[dict[str, str]], list[str], str, list[str]]:
-        doc_id = self._doc_key_gen()
+    def load_txt(self, file_name, chunk_strategy, doc_id=None) -> tuple[list[dict[str, str]], list[str], str, list[str]]:
+        doc_id = doc_id or self._doc_key_gen()
 
         # Load the pdf with the filename
         with open(file_name, 'r') as file:
             txt_file = file.read()
 
         page_chunks, paragraph_keys, big_string_list = self._text_splitter(txt_file, chunk_strategy)
+        paragraph_keys = self._content_keys(doc_id, page_chunks, big_string_list, paragraph_keys)
         paragraph_list = self._make_paragraph_list(page_chunks, doc_id)
 
         return paragraph_list, paragraph_keys, doc_id, big_string_list
 
-    def load_docx(self, file_name, chunk_strategy) -> tuple[list[dict[str, str]], list[str], str, list[str]]:
-        doc_id = self._doc_key_gen()
+    def load_docx(self, file_name, chunk_strategy, doc_id=None) -> tuple[list[dict[str, str]], list[str], str, list[str]]:
+        doc_id = doc_id or self._doc_key_gen()
 
-        # Load the pdf with the filename
-        doc = Document(file_name)
-        list_docx = [paragraph.text for paragraph in doc.paragraphs]
-        text_docx = "".join([item for item in list_docx])
+        # Load the docx with the filename
+        text_docx = "".join(self.iter_docx_pages(file_name))
 
         page_chunks, paragraph_keys, big_string_list = self._text_splitter(text_docx, chunk_strategy)
+        paragraph_keys = self._content_keys(doc_id, page_chunks, big_string_list, paragraph_keys)
         paragraph_list = self._make_paragraph_list(page_chunks, doc_id)
 
         return paragraph_list, paragraph_keys, doc_id, big_string_list
 
-    def load_youtube(self, youtube_id, chunk_strategy) -> tuple[list[dict[str, str]], list[str], str, list[str]]:
-        doc_id = self._doc_key_gen()
+    def load_youtube(self, youtube_id, chunk_strategy, doc_id=None) -> tuple[list[dict[str, str]], list[str], str, list[str]]:
+        doc_id = doc_id or self._doc_key_gen()
         text_video = self._get_transcript_api(youtube_id)
 
         page_chunks, paragraph_keys, big_string_list = self._text_splitter(text_video, chunk_strategy)
+        paragraph_keys = self._content_keys(doc_id, page_chunks, big_string_list, paragraph_keys)
 
         paragraph_list = self._make_paragraph_list(page_chunks, doc_id)
 
         return paragraph_list, paragraph_keys, doc_id, big_string_list
+
+
+# Parse and chunk one file, runs in a worker process of the ingest command
+def parse_file(path: str, file_type: str, chunk_strategy: str, doc_id: str, id_scheme: str, text_storage: str) -> list:
+    document_reader = DocumentReader(id_scheme=id_scheme, text_storage=text_storage)
+    return list(document_reader.iter_chunks(document_reader.iter_pages(file_type, path), chunk_strategy, doc_id=doc_id,
+                                            source_id=document_reader.file_source_id(doc_id, path)))
@@ -0,0 +1,153 @@
+import argparse
+import json
+import multiprocessing
+import os
+import sys
+import time
+import yaml
+from concurrent.futures import ProcessPoolExecutor
+from .document_reader import DocumentReader
+from .document_reader.document_reader import parse_file
+
+
+FILE_TYPES = {".pdf": "pdf", ".txt": "txt", ".docx": "docx"}
+MANIFEST_NAME = ".local_rag_manifest.json"
+
+
+def _find_files(directory: str) -> list:
+    files = []
+    for root, _, names in os.walk(directory):
+        for name in sorted(names):
+            extension = os.path.splitext(name)[1].lower()
+            if extension in FILE_TYPES:
+                files.append(os.path.join(root, name))
+
+    return sorted(files)
+
+
+def _file_signature(path: str) -> dict:
+    stat = os.stat(path)
+    return {"size": stat.st_size, "mtime": stat.st_mtime}
+
+
+def load_manifest(manifest_path: str, store: str, doc_id: str) -> dict:
+    if os.path.isfile(manifest_path):
+        with open(manifest_path, 'r') as file:
+            manifest = json.load(file)
+
+        # A manifest written for another store doesn't describe this one
+        if manifest.get("store") == store and manifest.get("doc_id") == doc_id:
+            return manifest
+
+    return {"store": store, "doc_id": doc_id, "files": {}}
+
+
+def save_manifest(manifest_path: str, manifest: dict) -> None:
+    # Write then rename so an interrupted run never leaves a truncated manifest
+    temp_path = manifest_path + ".tmp"
+    with open(temp_path, 'w') as file:
+        json.dump(manifest, file, indent=2)
+    os.replace(temp_path, manifest_path)
+
+
+def _iter_parsed_chunks(files: list, chunk_strategy: str, workers: int, doc_id: str, id_scheme: str = "random",
+                        text_storage: str = "spans"):
+    from .ingest_pipeline import Checkpoint
+
+    # Parse in worker processes, with a bounded number of files in flight, and mark the end of every file. Workers
+    # are spawned, not forked, as this runs beside the embed thread and the pooled database connections
+    with ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context("spawn")) as executor:
+        pending = list(files)
+        in_flight = []
+
+        while pending or in_flight:
+            while pending and len(in_flight) < 2 * workers:
+                path = pending.pop(0)
+                in_flight.append((path, executor.submit(parse_file, path, FILE_TYPES[os.path.splitext(path)[1].lower()],
+                                                          chunk_strategy, doc_id, id_scheme, text_storage)))
+
+            path, future = in_flight.pop(0)
+            chunks = future.result()
+            yield from chunks
+            yield Checkpoint((path, len(chunks)))
+
+
+def main(argv=None) -> None:
+    # Imported here, a spawned parse worker imports this module again and only needs the document reader
+    from .database import DocumentDB, get_vector_database
+    from .ingest_pipeline import IngestPipeline
+    from .migrate import default_config_file
+
+    parser = argparse.ArgumentParser(prog="python -m local_rag.ingest",
+                                     description="Ingest every pdf, txt and docx file in a directory into a document store.")
+    parser.add_argument("directory", help="Directory to walk for pdf, txt and docx files.")
+    parser.add_argument("--store", required=True, help="Name of the document store, created when it doesn't exist.")
+    parser.add_argument("--chunk-strategy", default="smalltobig", choices=["simple", "smalltobig"],
+                        help="Chunking strategy for a new store, an existing store keeps its own.")
+    parser.add_argument("--config", default=default_config_file(), help="Path to the yaml config file.")
+    parser.add_argument("--workers", type=int, default=os.cpu_count() or 1, help="Parser worker processes.")
+    parser.add_argument("--manifest", default=None, help=f"Progress manifest, defaults to {MANIFEST_NAME} in the directory.")
+    args = parser.parse_args(argv)
+
+    # Use the existing store or create it
+    document_db = DocumentDB(args.config)
+    existing = document_db.get_doc_by_name(args.store)
+    if existing is not None:
+        doc_id, chunk_strategy = existing
+    else:
+        doc_id, chunk_strategy = DocumentReader._doc_key_gen(), args.chunk_strategy
+        document_db.add_document(args.store, doc_id, chunk_strategy)
+
+    manifest_path = args.manifest or os.path.join(args.directory, MANIFEST_NAME)
+    manifest = load_manifest(manifest_path, args.store, doc_id)
+
+    # Skip files completed by an earlier run that haven't changed since
+    all_files = _find_files(args.directory)
+    files = []
+    for path in all_files:
+        done = manifest["files"].get(os.path.relpath(path, args.directory))
+        signature = _file_signature(path)
+        if done is None or done["size"] != signature["size"] or done["mtime"] != signature["mtime"]:
+            files.append(path)
+
+    skipped = len(all_files) - len(files)
+    print(f"Ingesting {len(files)} files into {args.store} ({skipped} already done)")
+    if not files:
+        return
+
+    files_done = 0
+    start = time.perf_counter()
+
+    def on_checkpoint(value):
+        nonlocal files_done
+        path, n_chunks = value
+        files_done += 1
+        manifest["files"][os.path.relpath(path, args.directory)] = {**_file_signature(path), "chunks": n_chunks}
+        save_manifest(manifest_path, manifest)
+
+    def on_progress(stats):
+        print(f"\r{files_done}/{len(files)} files, {stats['chunks']} chunks, {stats['chunks_per_sec']:.1f} chunks/sec",
+              end="", file=sys.stderr, flush=True)
+
+    with open(args.config, 'r') as stream:
+        data_loaded = yaml.safe_load(stream)
+    id_scheme = data_loaded.get("id_scheme", "random")
+    text_storage = data_loaded.get("text_storage", "spans")
+
+    chunks = _iter_parsed_chunks(files, chunk_strategy, max(1, args.workers), doc_id, id_scheme, text_storage)
+    stats = IngestPipeline(args.config).run(chunks, args.store, doc_id, on_progress=on_progress, on_checkpoint=on_checkpoint)
+    print(file=sys.stderr)
+
+    # One index build after the bulk load, a no-op when the store already has its index
+    get_vector_database(args.config, doc_id).ensure_cosine_index()
+
+    elapsed = time.perf_counter() - start
+    print(f"Ingested {files_done} files and {stats['chunks']} chunks in {elapsed:.1f}s "
+          f"({stats['chunks'] / elapsed if elapsed else 0.0:.1f} chunks/sec, first batch stored after "
+          f"{stats['first_store_seconds'] or 0.0:.1f}s)")
+    if stats["padding_efficiency"] is not None:
+        print(f"Padding efficiency: {stats['padding_efficiency']:.1%} of the embedded tokens were real tokens")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,213 @@
+import queue
+import threading
+import time
+from typing import Callable, Iterator
+import yaml
+from .database import VectorDatabase, DocumentTextDB, EmbeddingCacheDB, get_vector_database
+from .ml_models import EmbeddingClass
+
+
+class Checkpoint:
+    """
+    Marker that can be mixed into the chunk stream of IngestPipeline.run. It flows through every stage in order, so
+    on_checkpoint is called with its value once every chunk before it has been stored.
+    """
+
+    def __init__(self, value):
+        self.value = value
+
+
+class _StageError:
+    def __init__(self, error: BaseException):
+        self.error = error
+
+
+_DONE = object()
+
+
+class IngestPipeline:
+    """
+    IngestPipeline
+
+    Streams chunks through three overlapped stages: chunking (the caller's generator, run on a worker thread),
+    embedding in bounded batches, and storing each batch in the paragraph text table and the vector store. The stages
+    are connected by bounded queues, so a slow stage holds back the ones before it and memory stays bounded by
+    ingest_queue_size batches of ingest_batch_size chunks.
+
+    Methods:
+        run(chunks, doc_name: str, doc_id: str, on_progress: Callable = None, on_checkpoint: Callable = None) -> dict:
+            Ingests (text to embed, paragraph key, big string) tuples, with an optional (source id, sentence position)
+            span, into the document store doc_id and returns throughput stats. With id_scheme set to content, chunks that are already stored are skipped and counted.
+            padding_efficiency is the share of real tokens among the padded tokens embedded, None when nothing was
+            embedded with length-aware batching.
+    """
+
+    def __init__(self, config_file):
+        with open(config_file, 'r') as stream:
+            data_loaded = yaml.safe_load(stream)
+        self.config_file = config_file
+        self.batch_size = int(data_loaded.get("ingest_batch_size", 256))
+        self.queue_size = int(data_loaded.get("ingest_queue_size", 4))
+        self.use_embedding_cache = data_loaded.get("embedding_cache", True)
+        self.id_scheme = data_loaded.get("id_scheme", "random")
+        self.skipped = 0
+        self.real_tokens = 0
+        self.padded_tokens = 0
+
+    def _padding_efficiency(self):
+        return self.real_tokens / self.padded_tokens if self.padded_tokens else None
+
+    @staticmethod
+    def _put(out_queue: queue.Queue, item, stop: threading.Event) -> bool:
+        # Block while the next stage is busy, but give up when the pipeline is stopping
+        while not stop.is_set():
+            try:
+                out_queue.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                continue
+
+        return False
+
+    def _chunk_stage(self, chunks, out_queue: queue.Queue, stop: threading.Event) -> None:
+        batch = []
+        try:
+            for item in chunks:
+                if stop.is_set():
+                    return
+
+                if isinstance(item, Checkpoint):
+                    if batch and not self._put(out_queue, batch, stop):
+                        return
+                    batch = []
+                    if not self._put(out_queue, item, stop):
+                        return
+                    continue
+
+                batch.append(item)
+                if len(batch) >= self.batch_size:
+                    if not self._put(out_queue, batch, stop):
+                        return
+                    batch = []
+
+            if batch and not self._put(out_queue, batch, stop):
+                return
+            self._put(out_queue, _DONE, stop)
+        except BaseException as e:
+            self._put(out_queue, _StageError(e), stop)
+
+    def _drop_stored_chunks(self, batch: list, vec_db: VectorDatabase, seen: set) -> list:
+        # With content ids a chunk that is already stored, or repeated in this run, has a known key and is skipped
+        stored = vec_db.existing_paragraph_ids([chunk[1] for chunk in batch])
+        new_batch = []
+        for chunk in batch:
+            if chunk[1] not in stored and chunk[1] not in seen:
+                seen.add(chunk[1])
+                new_batch.append(chunk)
+        self.skipped += len(batch) - len(new_batch)
+
+        return new_batch
+
+    def _embed_stage(self, in_queue: queue.Queue, out_queue: queue.Queue, stop: threading.Event, vec_db: VectorDatabase) -> None:
+        try:
+            embedding_class = EmbeddingClass(self.config_file)
+            seen = set()
+            embedding_cache = EmbeddingCacheDB(self.config_file) if self.use_embedding_cache else None
+
+            while not stop.is_set():
+                try:
+                    item = in_queue.get(timeout=0.1)
+                except queue.Empty:
+                    continue
+
+                if item is _DONE or isinstance(item, _StageError):
+                    self._put(out_queue, item, stop)
+                    return
+
+                if isinstance(item, Checkpoint):
+                    if not self._put(out_queue, item, stop):
+                        return
+                    continue
+
+                if self.id_scheme == "content":
+                    item = self._drop_stored_chunks(item, vec_db, seen)
+                    if not item:
+                        continue
+
+                embeddings = embedding_class.batch_embedding([{"text": chunk[0]} for chunk in item], cache=embedding_cache)
+                self.real_tokens = embedding_class.real_tokens
+                self.padded_tokens = embedding_class.padded_tokens
+                if not self._put(out_queue, (item, embeddings), stop):
+                    return
+        except BaseException as e:
+            self._put(out_queue, _StageError(e), stop)
+
+    def run(self, chunks: Iterator, doc_name: str, doc_id: str, on_progress: Callable = None,
+            on_checkpoint: Callable = None) -> dict:
+        chunk_queue = queue.Queue(maxsize=self.queue_size)
+        embed_queue = queue.Queue(maxsize=self.queue_size)
+        stop = threading.Event()
+
+        doc_text_db = DocumentTextDB(self.config_file)
+        vec_db = get_vector_database(self.config_file, doc_id)
+
+        chunk_thread = threading.Thread(target=self._chunk_stage, args=(chunks, chunk_queue, stop), daemon=True)
+        embed_thread = threading.Thread(target=self._embed_stage, args=(chunk_queue, embed_queue, stop, vec_db), daemon=True)
+
+        self.skipped = 0
+        self.real_tokens = 0
+        self.padded_tokens = 0
+        stats = {"chunks": 0, "batches": 0, "skipped": 0, "seconds": 0.0, "first_store_seconds": None,
+                 "chunks_per_sec": 0.0, "padding_efficiency": None}
+        start = time.perf_counter()
+        chunk_thread.start()
+        embed_thread.start()
+
+        try:
+            # Store stage, runs on the calling thread
+            while True:
+                item = embed_queue.get()
+
+                if item is _DONE:
+                    break
+
+                if isinstance(item, _StageError):
+                    raise ValueError("Error in the ingestion pipeline.") from item.error
+
+                if isinstance(item, Checkpoint):
+                    if on_checkpoint is not None:
+                        on_checkpoint(item.value)
+                    continue
+
+                batch, embeddings = item
+                paragraph_keys = [chunk[1] for chunk in batch]
+                window_rows = [(doc_name, doc_id, chunk[1], chunk[2]) for chunk in batch if len(chunk) == 3]
+                span_rows = [(doc_name, doc_id, chunk[1], chunk[0], *chunk[3]) for chunk in batch if len(chunk) == 4]
+                if window_rows:
+                    doc_text_db.add_bulk_documents(window_rows)
+                if span_rows:
+                    doc_text_db.add_bulk_spans(span_rows)
+                vec_db.insert_batch_vecs(embeddings, doc_id, paragraph_keys)
+
+                stats["chunks"] += len(batch)
+                stats["batches"] += 1
+                stats["skipped"] = self.skipped
+                stats["padding_efficiency"] = self._padding_efficiency()
+                stats["seconds"] = time.perf_counter() - start
+                stats["chunks_per_sec"] = stats["chunks"] / stats["seconds"] if stats["seconds"] else 0.0
+                if stats["first_store_seconds"] is None:
+                    stats["first_store_seconds"] = stats["seconds"]
+
+                if on_progress is not None:
+                    on_progress(dict(stats))
+        finally:
+            stop.set()
+            chunk_thread.join()
+            embed_thread.join()
+
+        stats["skipped"] = self.skipped
+        stats["padding_efficiency"] = self._padding_efficiency()
+        stats["seconds"] = time.perf_counter() - start
+        stats["chunks_per_sec"] = stats["chunks"] / stats["seconds"] if stats["seconds"] else 0.0
+
+        return stats
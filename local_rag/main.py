@@ -1,8 +1,15 @@
 import os
+import heapq
+import itertools
 import yaml
-from .document_reader import DocumentReader
-from .database import VectorDatabase, DocumentDB, DocumentTextDB
-from .ml_models import OllamaLLM, EmbeddingClass, EmbeddingReranker
+from concurrent.futures import ThreadPoolExecutor
+from typing import Iterator
+from .document_reader import DocumentReader, close_extraction_pools
+from .database import VectorDatabase, DocumentDB, DocumentTextDB, EmbeddingCacheDB, close_all_pools, get_vector_database
+from .ingest_pipeline import IngestPipeline
+from .context_builder import ContextBuilder
+from .ml_models import OllamaLLM, EmbeddingClass, EmbeddingReranker, model_registry, close_http_sessions, get_answer_cache, \
+    invalidate_answer_caches
 
 
 class LocalRag:
@@ -11,7 +18,107 @@ class LocalRag:
         with open(self.config_file, 'r') as stream:
             data_loaded = yaml.safe_load(stream)
         self.temp_storage = data_loaded["temp_doc_storage"]
-        self.document_reader_instance = DocumentReader()
+        self.embedding_device = data_loaded.get("embedding_device", "auto")
+        self.embedding_backend = data_loaded.get("embedding_backend", "auto")
+        self.embedding_threads = int(data_loaded.get("embedding_threads", 0))
+        self.reranker_device = data_loaded.get("reranker_device", "auto")
+        self.reranker_precision = data_loaded.get("reranker_precision", "fp32")
+        self.use_embedding_cache = data_loaded.get("embedding_cache", True)
+        self.search_workers = int(data_loaded.get("search_workers", 8))
+        self.index_build_mode = data_loaded.get("index_build_mode", "background")
+        self.id_scheme = data_loaded.get("id_scheme", "random")
+        self.text_storage = data_loaded.get("text_storage", "spans")
+        self.retrieval_mode = data_loaded.get("retrieval_mode", "vector")
+        self.rrf_k = int(data_loaded.get("rrf_k", 60))
+        self.hybrid_oversample = int(data_loaded.get("hybrid_oversample", 2))
+        if self.retrieval_mode not in ("vector", "lexical", "hybrid"):
+            raise ValueError(f"Unknown retrieval_mode {self.retrieval_mode}, choose vector, lexical or hybrid.")
+
+        self.context_token_budget = int(data_loaded.get("context_token_budget", 1536))
+        self.sentence_window = int(data_loaded.get("sentence_window", 8))
+
+        # Answers are only reused when the model is deterministic
+        self.llm_model = data_loaded.get("model_name")
+        self.answer_cache = None
+        if int(data_loaded.get("answer_cache_size", 256)) > 0 and float(data_loaded.get("temperature", 0) or 0) == 0:
+            self.answer_cache = get_answer_cache(
+                int(data_loaded.get("answer_cache_size", 256)),
+                float(data_loaded.get("answer_cache_ttl", 86400)),
+                float(data_loaded.get("answer_cache_threshold", 0.95))
+            )
+        self.document_reader_instance = DocumentReader(
+            extraction_workers=int(data_loaded.get("extraction_workers", 1)),
+            shard_pages=int(data_loaded.get("extraction_shard_pages", 16)),
+            id_scheme=data_loaded.get("id_scheme", "random"),
+            text_storage=self.text_storage
+        )
+
+    def warmup_models(self) -> None:
+        model_registry.warmup(self.embedding_device, self.reranker_device, self.embedding_backend, self.reranker_precision,
+                              self.embedding_threads)
+
+    @staticmethod
+    def unload_models(kind: str = None) -> None:
+        model_registry.unload(kind)
+
+    @staticmethod
+    def close_connections() -> None:
+        close_all_pools()
+        close_http_sessions()
+        close_extraction_pools()
+
+    @staticmethod
+    def _resolve_doc_id(document_db: DocumentDB, doc_name: str) -> str:
+        # Chunks added to an existing store must carry its doc_id, content ids are derived from it
+        document = document_db.get_doc_by_name(doc_name)
+        if document is None:
+            raise ValueError(f"No document store named {doc_name}.")
+
+        return document[0]
+
+    # Return the paragraph keys and the matching entries of every other column for the chunks still to be stored
+    def _drop_stored_chunks(self, doc_id: str, paragraph_keys: list, *columns) -> tuple:
+        # With content ids a chunk that is already stored has the same key, so re-ingesting it is skipped
+        if self.id_scheme != "content":
+            return paragraph_keys, *columns
+
+        stored = get_vector_database(self.config_file, doc_id).existing_paragraph_ids(paragraph_keys)
+        seen = set()
+        keep = []
+        for x, paragraph_id in enumerate(paragraph_keys):
+            if paragraph_id not in stored and paragraph_id not in seen:
+                seen.add(paragraph_id)
+                keep.append(x)
+
+        return [paragraph_keys[x] for x in keep], *([column[x] for x in keep] for column in columns)
+
+    def _stores_spans(self, chunk_strategy: str) -> bool:
+        return chunk_strategy == "smalltobig" and self.text_storage == "spans"
+
+    def _add_texts(self, doc_name: str, doc_id: str, chunk_strategy: str, paragraph_list: list, paragraph_keys: list,
+                   big_string_list: list, spans: list) -> None:
+        doc_text_db = DocumentTextDB(self.config_file)
+        data_in = []
+
+        # Small-to-big sentences stored as spans keep only the sentence, the window is rebuilt when it is fetched
+        if self._stores_spans(chunk_strategy):
+            for paragraph_id, paragraph, span in zip(paragraph_keys, paragraph_list, spans):
+                data_in.append((doc_name, doc_id, paragraph_id, paragraph["paragraph"], *span))
+            doc_text_db.add_bulk_spans(data_in)
+            return
+
+        for paragraph_id, paragraph in zip(paragraph_keys, big_string_list):
+            data_in.append((doc_name, doc_id, paragraph_id, paragraph))
+        doc_text_db.add_bulk_documents(data_in)
+
+    # Return the paragraph keys and spans of a whole text, taken before any chunk is dropped so positions match it
+    def _sentence_spans(self, chunk_strategy: str, doc_id: str, paragraph_list: list, paragraph_keys: list,
+                        big_string_list: list) -> tuple:
+        if self._stores_spans(chunk_strategy):
+            return self.document_reader_instance._sentence_spans(
+                doc_id, [paragraph["paragraph"] for paragraph in paragraph_list], big_string_list, paragraph_keys)
+
+        return paragraph_keys, [None] * len(paragraph_keys)
 
     def document_reader(self, load_func_str, file_name, doc_name, chunk_strategy, add_to_doc=False):
         if not doc_name:
@@ -27,11 +134,17 @@ class LocalRag:
 
         try:
             document_db = DocumentDB(self.config_file)
+            doc_id = self._resolve_doc_id(document_db, doc_name) if add_to_doc else None
             paragraph_list, paragraph_keys, doc_id, big_string_list = load_func(f"{self.temp_storage}/{file_name}",
-                                                                                chunk_strategy)
+                                                                                chunk_strategy, doc_id)
         except Exception as e:
             raise ValueError("Error in load_func execution.") from e
 
+        paragraph_keys, spans = self._sentence_spans(chunk_strategy, doc_id, paragraph_list, paragraph_keys,
+                                                     big_string_list)
+        paragraph_keys, paragraph_list, big_string_list, spans = self._drop_stored_chunks(
+            doc_id, paragraph_keys, paragraph_list, big_string_list, spans)
+
         if not add_to_doc:
             try:
                 document_db.add_document(doc_name, doc_id, chunk_strategy)
@@ -39,12 +152,7 @@ class LocalRag:
                 raise ValueError("Error in add_document execution.") from e
 
         try:
-            doc_text_db = DocumentTextDB(self.config_file)
-            data_in = []
-
-            for paragraph_id, paragraph in zip(paragraph_keys, big_string_list):
-                data_in.append((doc_name, doc_id, paragraph_id, paragraph))
-            doc_text_db.add_bulk_documents(data_in)
+            self._add_texts(doc_name, doc_id, chunk_strategy, paragraph_list, paragraph_keys, big_string_list, spans)
         except Exception as e:
             raise ValueError("Error in adding document texts.") from e
 
@@ -52,7 +160,12 @@ class LocalRag:
 
     def youtube_reader_helper(self, file_name, doc_name, chunk_strategy, add_to_doc=False):
         document_db = DocumentDB(self.config_file)
-        paragraph_list, paragraph_keys, doc_id, big_string_list = self.document_reader_instance.load_youtube(file_name, chunk_strategy)
+        doc_id = self._resolve_doc_id(document_db, doc_name) if add_to_doc else None
+        paragraph_list, paragraph_keys, doc_id, big_string_list = self.document_reader_instance.load_youtube(file_name, chunk_strategy, doc_id)
+        paragraph_keys, spans = self._sentence_spans(chunk_strategy, doc_id, paragraph_list, paragraph_keys,
+                                                     big_string_list)
+        paragraph_keys, paragraph_list, big_string_list, spans = self._drop_stored_chunks(
+            doc_id, paragraph_keys, paragraph_list, big_string_list, spans)
 
         if not add_to_doc:
             try:
@@ -61,12 +174,7 @@ class LocalRag:
                 raise ValueError("Error in add_document execution.") from e
 
         try:
-            doc_text_db = DocumentTextDB(self.config_file)
-            data_in = []
-
-            for paragraph_id, paragraph in zip(paragraph_keys, big_string_list):
-                data_in.append((doc_name, doc_id, paragraph_id, paragraph))
-            doc_text_db.add_bulk_documents(data_in)
+            self._add_texts(doc_name, doc_id, chunk_strategy, paragraph_list, paragraph_keys, big_string_list, spans)
         except Exception as e:
             raise ValueError("Error in adding document texts.") from e
 
@@ -103,19 +211,28 @@ class LocalRag:
         if doc_id is None:
             raise ValueError("Invalid doc_id. It cannot be None.")
 
+        # Every chunk may already be stored when a document is re-ingested
+        if not pdf_in:
+            return []
+
         try:
             embedding_class = EmbeddingClass(self.config_file)
+            embedding_cache = EmbeddingCacheDB(self.config_file) if self.use_embedding_cache else None
 
             # Create vector batch
             emb_list = [{"text": item["paragraph"]} for item in pdf_in]
-            embedding = embedding_class.batch_embedding(emb_list)
+            embedding = embedding_class.batch_embedding(emb_list, cache=embedding_cache)
 
         except Exception as e:
             raise ValueError("Error in creating batch embeddings.") from e
 
         return embedding
 
-    def load_documents_db(self, embeddings: list, paragraph_keys: list, doc_id: str) -> None:
+    def load_documents_db(self, embeddings: list, paragraph_keys: list, doc_id: str, build_index: bool = True) -> None:
+        # Nothing new to store after a re-ingest
+        if isinstance(embeddings, list) and not embeddings and paragraph_keys == []:
+            return
+
         if not embeddings or not isinstance(embeddings, list):
             raise ValueError("Invalid embeddings. They should be provided as a list.")
 
@@ -125,11 +242,119 @@ class LocalRag:
         if doc_id is None or not isinstance(doc_id, str) or doc_id == "":
             raise ValueError("Invalid doc_id. It cannot be None or an empty string.")
 
-        vec_db = VectorDatabase(self.config_file, doc_id)
+        vec_db = get_vector_database(self.config_file, doc_id)
         vec_db.insert_batch_vecs(embeddings, doc_id, paragraph_keys)
-        vec_db.make_cosine_index()
+        invalidate_answer_caches(doc_id)
+
+        if build_index:
+            self._build_index(vec_db)
+
+    def _build_index(self, vec_db: VectorDatabase) -> None:
+        # An existing HNSW index absorbs the new vectors, so only a new store needs an index build
+        if self.index_build_mode != "deferred":
+            vec_db.ensure_cosine_index(background=self.index_build_mode == "background")
+
+    def ingest_document(self, file_type: str, file_name: str, doc_name: str, chunk_strategy: str, doc_id: str = None,
+                        on_progress=None) -> str:
+        if not doc_name:
+            raise ValueError("doc_name cannot be empty.")
+
+        if chunk_strategy is None:
+            raise ValueError("Invalid chunk_strategy. It cannot be None.")
+
+        # Without a doc_id the store of that name is used, so retrying a crashed upload resumes it instead of making a
+        # second store, and a new store is created only when there is none
+        if doc_id is None:
+            document_db = DocumentDB(self.config_file)
+            existing = document_db.get_doc_by_name(doc_name)
+            if existing is not None:
+                doc_id, chunk_strategy = existing
+            else:
+                doc_id = self.document_reader_instance._doc_key_gen()
+                document_db.add_document(doc_name, doc_id, chunk_strategy)
+
+        # Pages stream into the chunker and each embedded batch is stored as soon as it is ready
+        file_path = f"{self.temp_storage}/{file_name}"
+        pages = self.document_reader_instance.iter_pages(file_type, file_path)
+        chunks = self.document_reader_instance.iter_chunks(
+            pages, chunk_strategy, doc_id=doc_id,
+            source_id=self.document_reader_instance.file_source_id(doc_id, file_path))
+
+        try:
+            IngestPipeline(self.config_file).run(chunks, doc_name, doc_id, on_progress=on_progress)
+        except Exception as e:
+            raise ValueError(f"Error while ingesting {file_type} document.") from e
+        finally:
+            invalidate_answer_caches(doc_id)
+
+        self._build_index(get_vector_database(self.config_file, doc_id))
+
+        return doc_id
+
+    def build_indexes(self, doc_ids: list, background: bool = False) -> None:
+        # Used after bulk loads made with build_index=False or with index_build_mode set to deferred
+        for doc_id in dict.fromkeys(doc_ids):
+            get_vector_database(self.config_file, doc_id).ensure_cosine_index(background=background)
+
+    def index_status(self, doc_id: str) -> dict:
+        if doc_id is None or not isinstance(doc_id, str) or doc_id == "":
+            raise ValueError("Invalid doc_id. It cannot be None or an empty string.")
+
+        return get_vector_database(self.config_file, doc_id).index_status()
+
+    @staticmethod
+    def _fuse_rankings(rankings: list, k: int, rrf_k: int = 60) -> list:
+        # Reciprocal rank fusion, a paragraph scores 1 / (rrf_k + rank) in every ranking it appears in
+        scores = {}
+        for ranking in rankings:
+            for rank, paragraph_id in enumerate(ranking, start=1):
+                scores[paragraph_id] = scores.get(paragraph_id, 0.0) + 1.0 / (rrf_k + rank)
+
+        return heapq.nlargest(k, scores.items(), key=lambda item: item[1])
+
+    def _vector_search(self, prompt: str, k: int, doc_ids: list) -> list:
+        embedding_class = EmbeddingClass(self.config_file)
+        query_emb = embedding_class.return_embedding(prompt)
+
+        # get_matches returns the farthest match first, results here are closest first like the other modes
+        if len(doc_ids) == 1:
+            return sorted(get_vector_database(self.config_file, doc_ids[0]).get_matches(query_emb, k), key=lambda d: d[1])
+
+        # Embed once and search every store concurrently
+        def search_store(store_id):
+            return get_vector_database(self.config_file, store_id).get_matches(query_emb, k)
+
+        with ThreadPoolExecutor(max_workers=min(self.search_workers, len(doc_ids))) as executor:
+            store_results = list(executor.map(search_store, doc_ids))
+
+        # Global top k by cosine distance, closest first
+        return heapq.nsmallest(k, itertools.chain.from_iterable(store_results), key=lambda d: d[1])
+
+    # Return the paragraph ids and their scores for the retrieval mode, best match first whatever the mode and the
+    # number of stores: cosine distances for vector, full-text ranks for lexical and fused scores for hybrid
+    def _search(self, prompt: str, k: int, doc_ids: list) -> tuple[list, list]:
+        if self.retrieval_mode == "lexical":
+            results = DocumentTextDB(self.config_file).lexical_search(prompt, doc_ids, k)
+            return [d[0] for d in results], [d[1] for d in results]
+
+        if self.retrieval_mode != "hybrid":
+            results = self._vector_search(prompt, k, doc_ids)
+            return [d[2]["paragraph_id"] for d in results], [d[1] for d in results]
+
+        # Both searches run at the same time, each returning a deeper candidate list for the fusion
+        candidates = k * self.hybrid_oversample
+        with ThreadPoolExecutor(max_workers=1) as executor:
+            lexical_future = executor.submit(DocumentTextDB(self.config_file).lexical_search, prompt, doc_ids, candidates)
+            vector_results = self._vector_search(prompt, candidates, doc_ids)
+            lexical_results = lexical_future.result()
 
-    def retrieve_documents(self, prompt: str, k: int, doc_id: str) -> tuple[list, list]:
+        fused = self._fuse_rankings([[d[2]["paragraph_id"] for d in vector_results], [d[0] for d in lexical_results]],
+                                    k, self.rrf_k)
+
+        return [d[0] for d in fused], [d[1] for d in fused]
+
+    # Return the paragraph ids, their scores and optionally their sources, best match first
+    def retrieve_documents(self, prompt: str, k: int, doc_id: str, return_sources: bool = False) -> tuple:
         if prompt is None or not isinstance(prompt, str) or prompt == "":
             raise ValueError("Invalid prompt. Make sure it's a valid string.")
 
@@ -139,14 +364,37 @@ class LocalRag:
         if doc_id is None or not isinstance(doc_id, str) or doc_id == "":
             raise ValueError("Invalid doc_id. It cannot be None or an empty string.")
 
-        embedding_class = EmbeddingClass(self.config_file)
-        vec_db = VectorDatabase(self.config_file, doc_id)
+        paragraph_id_list, cosine_sim = self._search(prompt, k, [doc_id])
 
-        query_emb = embedding_class.return_embedding(prompt)
-        results = vec_db.get_matches(query_emb, k)
+        # Fetch the sources in the same round trip budget as the search
+        if return_sources:
+            sources = self.get_paragraph_sources(paragraph_id_list) if paragraph_id_list else []
+            return paragraph_id_list, cosine_sim, sources
+
+        return paragraph_id_list, cosine_sim
+
+    # Same as retrieve_documents over several stores, or every store with "all", best match first
+    def retrieve_documents_multi(self, prompt: str, k: int, doc_ids, return_sources: bool = False) -> tuple:
+        if prompt is None or not isinstance(prompt, str) or prompt == "":
+            raise ValueError("Invalid prompt. Make sure it's a valid string.")
+
+        if k is None or not isinstance(k, int) or k <= 0:
+            raise ValueError("Invalid value for k. It should be an integer greater than 0.")
+
+        if doc_ids == "all":
+            doc_ids = DocumentDB(self.config_file).get_doc_ids()
+        elif not doc_ids or not isinstance(doc_ids, list):
+            raise ValueError("Invalid doc_ids. They should be a list of doc_ids or \"all\".")
 
-        cosine_sim = [d[1] for d in results]
-        paragraph_id_list = [d[2]["paragraph_id"] for d in results]
+        doc_ids = list(dict.fromkeys(doc_ids))
+        if not doc_ids:
+            return ([], [], []) if return_sources else ([], [])
+
+        paragraph_id_list, cosine_sim = self._search(prompt, k, doc_ids)
+
+        if return_sources:
+            sources = self.get_paragraph_sources(paragraph_id_list) if paragraph_id_list else []
+            return paragraph_id_list, cosine_sim, sources
 
         return paragraph_id_list, cosine_sim
 
@@ -154,27 +402,62 @@ class LocalRag:
         if not paragraph_id_list or not isinstance(paragraph_id_list, list):
             raise ValueError("Invalid paragraph_id_list. It should be a list.")
 
-        source_list = []
-
-        for paragraph_id in paragraph_id_list:
-            doc_text_db = DocumentTextDB(self.config_file)
-            source_list.append(doc_text_db.get_big_from_small(paragraph_id))
+        doc_text_db = DocumentTextDB(self.config_file)
 
-        return source_list
+        return doc_text_db.get_many(paragraph_id_list)
 
-    @staticmethod
-    def rerank_sources(query: str, sources: list) -> list:
+    def rerank_sources(self, query: str, sources: list, top_k: int = None, return_scores: bool = False):
         if query is None or not isinstance(query, str) or query == "":
             raise ValueError("Invalid query. Make sure it's a valid string.")
 
         if sources is None or not isinstance(sources, list):
             raise ValueError("Invalid sources. They should be a list of sources.")
 
-        reranker = EmbeddingReranker()
-        ranked_sources = reranker.rerank_data(query, sources)
+        if top_k is not None and (not isinstance(top_k, int) or top_k <= 0):
+            raise ValueError("Invalid value for top_k. It should be an integer greater than 0.")
+
+        reranker = EmbeddingReranker(self.config_file)
+        ranked_sources, scores = reranker.rerank_with_scores(query, sources, top_k)
+
+        if return_scores:
+            return ranked_sources, scores
 
         return ranked_sources
 
+    def build_context(self, sources: list) -> str:
+        if sources is None or not isinstance(sources, list):
+            raise ValueError("Invalid sources. They should be a list of sources.")
+
+        # Overlapping windows are merged so the prompt doesn't repeat sentences, then packed under the token budget.
+        # Sources are taken best first, as retrieve_documents and rerank_sources return them, so the worst are cut
+        return ContextBuilder(self.context_token_budget).build(sources)
+
+    # Everything that changes the context or the model, so an answer is never reused for a different context
+    def _answer_params(self, k: int, rank_strategy: str, gen_content: bool) -> tuple:
+        return (k, rank_strategy, gen_content, self.llm_model, self.retrieval_mode, self.context_token_budget,
+                self.sentence_window)
+
+    # Return the cached (answer, sources) of a close enough earlier question, or None
+    def lookup_answer(self, query: str, doc_id: str, k: int, rank_strategy: str, gen_content: bool = False):
+        if self.answer_cache is None:
+            return None
+
+        if query is None or not isinstance(query, str) or query == "":
+            raise ValueError("Invalid query. Make sure it's a valid string.")
+
+        # The query embedding is cached, so the search that follows a miss doesn't embed it again
+        query_emb = EmbeddingClass(self.config_file).return_embedding(query)
+
+        return self.answer_cache.get(doc_id, self._answer_params(k, rank_strategy, gen_content), query_emb)
+
+    def store_answer(self, query: str, doc_id: str, k: int, rank_strategy: str, answer: str, sources: list,
+                     gen_content: bool = False) -> None:
+        if self.answer_cache is None or not answer:
+            return
+
+        query_emb = EmbeddingClass(self.config_file).return_embedding(query)
+        self.answer_cache.put(doc_id, self._answer_params(k, rank_strategy, gen_content), query_emb, answer, sources)
+
     def make_llm_request(self, prompt: str, context: str, gen_content: bool = False) -> str:
         if prompt is None or not isinstance(prompt, str) or prompt == "":
             raise ValueError("Invalid prompt. Make sure it's a valid string.")
@@ -187,6 +470,28 @@ class LocalRag:
 
         return result
 
+    async def make_llm_request_async(self, prompt: str, context: str, gen_content: bool = False) -> str:
+        if prompt is None or not isinstance(prompt, str) or prompt == "":
+            raise ValueError("Invalid prompt. Make sure it's a valid string.")
+
+        if context is None or not isinstance(context, str) or context == "":
+            raise ValueError("Invalid context. Make sure it's a valid string.")
+
+        ollama_llm = OllamaLLM(self.config_file)
+
+        return await ollama_llm.async_chat_request(prompt, context, gen_content)
+
+    def stream_llm_request(self, prompt: str, context: str, gen_content: bool = False) -> Iterator[str]:
+        if prompt is None or not isinstance(prompt, str) or prompt == "":
+            raise ValueError("Invalid prompt. Make sure it's a valid string.")
+
+        if context is None or not isinstance(context, str) or context == "":
+            raise ValueError("Invalid context. Make sure it's a valid string.")
+
+        ollama_llm = OllamaLLM(self.config_file)
+
+        return ollama_llm.stream_chat_request(prompt, context, gen_content)
+
     def get_sql_documents(self) -> list:
         document_db = DocumentDB(self.config_file)
         return document_db.get_docs()
@@ -196,9 +501,10 @@ class LocalRag:
             raise ValueError("Invalid doc_id. It cannot be None or an empty string.")
 
         document_db = DocumentDB(self.config_file)
-        vec_db = VectorDatabase(self.config_file, doc_id)
+        vec_db = get_vector_database(self.config_file, doc_id)
         doc_text_db = DocumentTextDB(self.config_file)
 
         vec_db.delete_vecs()
         document_db.delete_document(doc_id)
         doc_text_db.delete_document(doc_id)
+        invalidate_answer_caches(doc_id)
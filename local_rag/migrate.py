@@ -0,0 +1,38 @@
+import argparse
+import os
+import yaml
+from .database.migrations import MIGRATIONS, current_version, migrate
+
+
+def default_config_file() -> str:
+    if os.path.isfile("config_real.yaml"):
+        return "config_real.yaml"
+
+    return "config.yaml"
+
+
+def main(argv=None) -> None:
+    parser = argparse.ArgumentParser(prog="python -m local_rag.migrate",
+                                     description="Create or upgrade the Local Rag database schema.")
+    parser.add_argument("--config", default=default_config_file(), help="Path to the yaml config file.")
+    parser.add_argument("--status", action="store_true", help="Only print the current schema version.")
+    args = parser.parse_args(argv)
+
+    with open(args.config, 'r') as stream:
+        data_loaded = yaml.safe_load(stream)
+
+    latest = MIGRATIONS[-1][0]
+
+    if args.status:
+        print(f"Schema version {current_version(data_loaded)} (latest {latest})")
+        return
+
+    applied = migrate(data_loaded)
+    if applied:
+        print(f"Applied migrations {', '.join(str(version) for version in applied)}, schema is at version {latest}")
+    else:
+        print(f"Schema is up to date at version {latest}")
+
+
+if __name__ == "__main__":
+    main()
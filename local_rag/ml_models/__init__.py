@@ -1 +1,6 @@
-from .ml_models import OllamaLLM, EmbeddingClass, EmbeddingReranker
\ No newline at end of file
+from .ml_models import OllamaLLM, EmbeddingClass, EmbeddingReranker
+from .model_registry import ModelRegistry, model_registry
+from .http_client import get_http_session, close_http_sessions
+from .embedding_cache import QueryEmbeddingCache, get_query_cache
+from .answer_cache import SemanticAnswerCache, get_answer_cache, invalidate_answer_caches
+from .embedding_backends import TorchEmbeddingBackend, QuantizedEmbeddingBackend, OnnxEmbeddingBackend
@@ -0,0 +1,122 @@
+import threading
+import time
+from collections import OrderedDict
+import numpy as np
+
+
+class SemanticAnswerCache:
+    """
+    SemanticAnswerCache
+
+    Bounded in-process LRU cache of LLM answers. A cached answer is returned for a new question asked with the same
+    document store and settings when the cosine similarity of the two question embeddings is at least threshold.
+    Entries expire after ttl seconds (0 disables expiry) and are dropped when their document store changes. Only
+    deterministic answers, generated with temperature 0, should be cached.
+
+    Methods:
+        get(doc_id: str, params: tuple, embedding) -> tuple | None:
+            Returns the (answer, sources) of the closest cached question or None.
+
+        put(doc_id: str, params: tuple, embedding, answer: str, sources: list) -> None:
+            Stores an answer with the sources it was generated from.
+
+        invalidate(doc_id: str = None) -> None:
+            Drops the answers of a document store and of searches over all stores, or every answer without a doc_id.
+
+        stats() -> dict:
+            Returns the hit and miss counters and the current size.
+    """
+
+    def __init__(self, max_size: int = 256, ttl: float = 86400, threshold: float = 0.95):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.threshold = threshold
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+        self._next_id = 0
+        self._lock = threading.Lock()
+
+    def _expired(self, created: float) -> bool:
+        return self.ttl > 0 and time.time() - created > self.ttl
+
+    @staticmethod
+    def _normalise(embedding) -> np.ndarray:
+        embedding = np.asarray(embedding, dtype=np.float32).ravel()
+        return embedding / max(float(np.linalg.norm(embedding)), 1e-12)
+
+    def get(self, doc_id: str, params: tuple, embedding):
+        query = self._normalise(embedding)
+
+        with self._lock:
+            for entry_id in [entry_id for entry_id, entry in self._entries.items() if self._expired(entry[5])]:
+                del self._entries[entry_id]
+
+            candidates = [(entry_id, entry) for entry_id, entry in self._entries.items()
+                          if entry[0] == doc_id and entry[1] == params]
+            if candidates:
+                similarities = np.stack([entry[2] for _, entry in candidates]) @ query
+                best = int(np.argmax(similarities))
+
+                if similarities[best] >= self.threshold:
+                    entry_id, entry = candidates[best]
+                    self._entries.move_to_end(entry_id)
+                    self.hits += 1
+                    return entry[3], list(entry[4])
+
+            self.misses += 1
+            return None
+
+    def put(self, doc_id: str, params: tuple, embedding, answer: str, sources: list) -> None:
+        with self._lock:
+            self._entries[self._next_id] = (doc_id, params, self._normalise(embedding), answer, list(sources), time.time())
+            self._next_id += 1
+
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+
+    def invalidate(self, doc_id: str = None) -> None:
+        with self._lock:
+            if doc_id is None:
+                self._entries.clear()
+                return
+
+            for entry_id in [entry_id for entry_id, entry in self._entries.items() if entry[0] in (doc_id, "all")]:
+                del self._entries[entry_id]
+
+    def stats(self) -> dict:
+        with self._lock:
+            total = self.hits + self.misses
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": self.hits / total if total else 0.0,
+                "size": len(self._entries),
+                "max_size": self.max_size
+            }
+
+
+_answer_caches = {}
+_answer_caches_lock = threading.Lock()
+
+
+# Return the process-wide cache for a set of cache settings
+def get_answer_cache(max_size: int = 256, ttl: float = 86400, threshold: float = 0.95) -> SemanticAnswerCache:
+    key = (max_size, ttl, threshold)
+
+    with _answer_caches_lock:
+        cache = _answer_caches.get(key)
+        if cache is None:
+            cache = SemanticAnswerCache(max_size, ttl, threshold)
+            _answer_caches[key] = cache
+
+    return cache
+
+
+# Drop the answers of a document store from every cache in the process, whatever its settings
+def invalidate_answer_caches(doc_id: str = None) -> None:
+    with _answer_caches_lock:
+        caches = list(_answer_caches.values())
+
+    for cache in caches:
+        cache.invalidate(doc_id)
@@ -0,0 +1,80 @@
+import argparse
+import time
+import numpy as np
+from .embedding_backends import EMBEDDING_BACKENDS
+from .model_registry import model_registry
+
+
+SAMPLE_TEXT = (
+    "Retrieval augmented generation combines a search step with a language model. "
+    "The documents are split into chunks which are embedded and stored in a vector database. "
+    "At query time the question is embedded and the closest chunks are retrieved. "
+    "The retrieved chunks are passed to the language model as context for the answer. "
+    "Small-to-big chunking embeds single sentences but returns the surrounding paragraph. "
+    "Re-ranking scores each retrieved chunk against the question with a cross-encoder. "
+    "Error code E1042 means the pump pressure sensor is disconnected. "
+    "Part number 7781-A replaces the older 7781 filter housing."
+)
+
+
+def _load_texts(file_name: str, n_texts: int) -> list:
+    if file_name:
+        with open(file_name, 'r') as file:
+            texts = [line.strip() for line in file if line.strip()]
+    else:
+        texts = [sentence.strip() + "." for sentence in SAMPLE_TEXT.split(".") if sentence.strip()]
+
+    # Repeat the sample to the requested size with varying lengths
+    return [" ".join(texts[(i + j) % len(texts)] for j in range(1 + i % 4)) for i in range(n_texts)]
+
+
+def _normalise(embeddings: np.ndarray) -> np.ndarray:
+    return embeddings / np.linalg.norm(embeddings, axis=1, keepdims=True)
+
+
+# Embed the texts with a backend and return the embeddings and throughput in chunks/sec
+def run_backend(backend: str, device: str, texts: list, batch_size: int, num_threads: int) -> tuple[np.ndarray, float]:
+    model = model_registry.get_embedding_model(device=device, backend=backend, num_threads=num_threads)
+    inputs = [{"text": text} for text in texts]
+
+    # Warm up before timing
+    model.encode(inputs[:batch_size], to_numpy=True)
+
+    start = time.perf_counter()
+    embeddings = [model.encode(inputs[i:i + batch_size], to_numpy=True) for i in range(0, len(inputs), batch_size)]
+    elapsed = time.perf_counter() - start
+
+    return np.vstack(embeddings), len(texts) / elapsed
+
+
+def main(argv=None) -> None:
+    parser = argparse.ArgumentParser(prog="python -m local_rag.ml_models.benchmark",
+                                     description="Compare embedding backends on throughput and agreement with fp32.")
+    parser.add_argument("--backends", nargs="+", default=list(EMBEDDING_BACKENDS), choices=list(EMBEDDING_BACKENDS))
+    parser.add_argument("--device", default="cpu", help="Device for the torch backend and the fp32 reference.")
+    parser.add_argument("--texts", default=None, help="File with one text per line, defaults to a built in sample.")
+    parser.add_argument("--n", type=int, default=256, help="Number of texts to embed.")
+    parser.add_argument("--batch-size", type=int, default=32)
+    parser.add_argument("--threads", type=int, default=0, help="CPU threads, 0 keeps the default.")
+    args = parser.parse_args(argv)
+
+    texts = _load_texts(args.texts, args.n)
+    reference, _ = run_backend("torch", args.device, texts, args.batch_size, args.threads)
+    reference = _normalise(reference)
+
+    print(f"{'backend':<10}{'chunks/sec':>12}{'mean cos':>12}{'min cos':>12}")
+    for backend in args.backends:
+        try:
+            embeddings, throughput = run_backend(backend, args.device, texts, args.batch_size, args.threads)
+        except ImportError as e:
+            print(f"{backend:<10} skipped: {e}")
+            continue
+
+        agreement = np.sum(_normalise(embeddings) * reference, axis=1)
+        print(f"{backend:<10}{throughput:>12.1f}{agreement.mean():>12.4f}{agreement.min():>12.4f}")
+        if backend != "torch":
+            model_registry.unload("embedding")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,114 @@
+import numpy as np
+import torch
+from angle_emb import AnglE
+from transformers import AutoTokenizer
+
+
+class TorchEmbeddingBackend:
+    """
+    TorchEmbeddingBackend
+
+    Runs the AnglE embedding model with PyTorch on the GPU or the CPU.
+
+    Attributes:
+        name (str): The backend name used in config.yaml.
+        device (str): The device the model runs on.
+        tokenizer (AutoTokenizer): The tokenizer of the model, used for length-aware batching.
+
+    Methods:
+        encode(inputs, to_numpy: bool = True) -> np.ndarray:
+            Embeds a {"text": ...} dict or a list of them, with the same call signature as AnglE.encode.
+    """
+    name = "torch"
+
+    def __init__(self, model_name: str, device: str, prompt: str, pooling_strategy: str, num_threads: int = 0):
+        if device == "cpu" and num_threads > 0:
+            torch.set_num_threads(num_threads)
+
+        self.device = device
+        self._model = AnglE.from_pretrained(model_name, pooling_strategy=pooling_strategy)
+        if device.startswith("cuda"):
+            self._model = self._model.cuda()
+        else:
+            self._model.backbone.to(device)
+            self._model.device = device
+        self._model.set_prompt(prompt=prompt)
+        self.tokenizer = self._model.tokenizer
+
+    def encode(self, inputs, to_numpy: bool = True):
+        return self._model.encode(inputs, to_numpy=to_numpy)
+
+
+class QuantizedEmbeddingBackend(TorchEmbeddingBackend):
+    """
+    QuantizedEmbeddingBackend
+
+    CPU backend running the AnglE model with its linear layers dynamically quantized to int8.
+    """
+    name = "int8"
+
+    def __init__(self, model_name: str, device: str, prompt: str, pooling_strategy: str, num_threads: int = 0):
+        super().__init__(model_name, "cpu", prompt, pooling_strategy, num_threads)
+        self._model.backbone = torch.quantization.quantize_dynamic(self._model.backbone, {torch.nn.Linear}, dtype=torch.qint8)
+
+
+class OnnxEmbeddingBackend:
+    """
+    OnnxEmbeddingBackend
+
+    CPU backend running an ONNX export of the embedding model with onnxruntime. Needs the optional optimum[onnxruntime]
+    package, the model is exported on first load.
+    """
+    name = "onnx"
+
+    def __init__(self, model_name: str, device: str, prompt: str, pooling_strategy: str, num_threads: int = 0):
+        try:
+            import onnxruntime
+            from optimum.onnxruntime import ORTModelForFeatureExtraction
+        except ImportError as e:
+            raise ImportError("The onnx embedding backend needs optimum[onnxruntime], install it with pip install optimum[onnxruntime]") from e
+
+        if pooling_strategy != "cls":
+            raise ValueError("The onnx embedding backend only supports cls pooling.")
+
+        session_options = onnxruntime.SessionOptions()
+        if num_threads > 0:
+            session_options.intra_op_num_threads = num_threads
+
+        self.device = "cpu"
+        self._prompt = prompt
+        self._model = ORTModelForFeatureExtraction.from_pretrained(model_name, export=True, session_options=session_options)
+        self.tokenizer = AutoTokenizer.from_pretrained(model_name)
+
+    def encode(self, inputs, to_numpy: bool = True):
+        if not isinstance(inputs, list):
+            inputs = [inputs]
+
+        texts = [self._prompt.format(**item) for item in inputs]
+        tokens = self.tokenizer(texts, padding='longest', truncation=True, max_length=512, return_tensors='pt')
+        outputs = self._model(**tokens)
+
+        # CLS pooling, matching the AnglE model
+        embeddings = outputs.last_hidden_state[:, 0]
+        if to_numpy:
+            return np.asarray(embeddings.detach().numpy() if hasattr(embeddings, "detach") else embeddings)
+
+        return embeddings
+
+
+EMBEDDING_BACKENDS = {
+    TorchEmbeddingBackend.name: TorchEmbeddingBackend,
+    QuantizedEmbeddingBackend.name: QuantizedEmbeddingBackend,
+    OnnxEmbeddingBackend.name: OnnxEmbeddingBackend,
+}
+
+
+# "auto" runs the fp32 torch model on the GPU when there is one and on the CPU otherwise
+def resolve_backend(backend: str = "auto") -> str:
+    if backend is None or backend == "" or backend == "auto":
+        return TorchEmbeddingBackend.name
+
+    if backend not in EMBEDDING_BACKENDS:
+        raise ValueError(f"Unknown embedding backend {backend}, choose one of auto, {', '.join(EMBEDDING_BACKENDS)}.")
+
+    return backend
@@ -0,0 +1,144 @@
+import hashlib
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+import numpy as np
+
+
+class QueryEmbeddingCache:
+    """
+    QueryEmbeddingCache
+
+    Bounded in-process LRU cache of query embeddings with an optional on-disk SQLite tier that can be shared by
+    several processes. Entries are keyed on the whitespace-normalised query text plus the model id and expire after
+    ttl seconds (0 disables expiry).
+
+    Methods:
+        make_key(text: str, model_id: str) -> str:
+            Returns the cache key for a query and model.
+
+        get(key: str) -> np.ndarray | None:
+            Returns the cached embedding or None, checking memory first and then the disk tier.
+
+        put(key: str, embedding: np.ndarray) -> None:
+            Stores an embedding in memory and in the disk tier.
+
+        stats() -> dict:
+            Returns the hit and miss counters and the current size.
+
+        clear() -> None:
+            Empties both tiers and resets the counters.
+    """
+
+    def __init__(self, max_size: int = 1024, ttl: float = 3600, disk_path: str = None):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self.disk_hits = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self._disk = None
+
+        if disk_path:
+            self._disk = sqlite3.connect(disk_path, check_same_thread=False, timeout=30)
+            self._disk.execute("CREATE TABLE IF NOT EXISTS query_embeddings (key TEXT PRIMARY KEY, embedding BLOB, dtype TEXT, created REAL)")
+            self._disk.commit()
+
+    @staticmethod
+    def make_key(text: str, model_id: str) -> str:
+        normalised = " ".join(text.split())
+        return hashlib.sha256(f"{model_id}\0{normalised}".encode("utf-8")).hexdigest()
+
+    def _expired(self, created: float) -> bool:
+        return self.ttl > 0 and time.time() - created > self.ttl
+
+    def _disk_get(self, key: str):
+        row = self._disk.execute("SELECT embedding, dtype, created FROM query_embeddings WHERE key = ?", (key,)).fetchone()
+        if row is None or self._expired(row[2]):
+            return None, None
+
+        return np.frombuffer(row[0], dtype=row[1]), row[2]
+
+    def get(self, key: str):
+        with self._lock:
+            entry = self._entries.get(key)
+
+            if entry is not None and not self._expired(entry[1]):
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return entry[0]
+
+            if entry is not None:
+                del self._entries[key]
+
+            if self._disk is not None:
+                embedding, created = self._disk_get(key)
+                if embedding is not None:
+                    self._store(key, embedding, created)
+                    self.hits += 1
+                    self.disk_hits += 1
+                    return embedding
+
+            self.misses += 1
+            return None
+
+    def _store(self, key: str, embedding: np.ndarray, created: float) -> None:
+        self._entries[key] = (embedding, created)
+        self._entries.move_to_end(key)
+
+        while len(self._entries) > self.max_size:
+            self._entries.popitem(last=False)
+
+    def put(self, key: str, embedding: np.ndarray) -> None:
+        embedding = np.asarray(embedding)
+        created = time.time()
+
+        with self._lock:
+            self._store(key, embedding, created)
+
+            if self._disk is not None:
+                self._disk.execute("INSERT OR REPLACE INTO query_embeddings (key, embedding, dtype, created) VALUES (?, ?, ?, ?)",
+                                   (key, embedding.tobytes(), embedding.dtype.str, created))
+                self._disk.commit()
+
+    def stats(self) -> dict:
+        with self._lock:
+            total = self.hits + self.misses
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "disk_hits": self.disk_hits,
+                "hit_rate": self.hits / total if total else 0.0,
+                "size": len(self._entries),
+                "max_size": self.max_size
+            }
+
+    def clear(self) -> None:
+        with self._lock:
+            self._entries.clear()
+            self.hits = 0
+            self.misses = 0
+            self.disk_hits = 0
+
+            if self._disk is not None:
+                self._disk.execute("DELETE FROM query_embeddings")
+                self._disk.commit()
+
+
+_query_caches = {}
+_query_caches_lock = threading.Lock()
+
+
+# Return the process-wide cache for a set of cache settings
+def get_query_cache(max_size: int = 1024, ttl: float = 3600, disk_path: str = None) -> QueryEmbeddingCache:
+    key = (max_size, ttl, disk_path or None)
+
+    with _query_caches_lock:
+        cache = _query_caches.get(key)
+        if cache is None:
+            cache = QueryEmbeddingCache(max_size, ttl, disk_path or None)
+            _query_caches[key] = cache
+
+    return cache
@@ -0,0 +1,44 @@
+import threading
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+
+_sessions = {}
+_sessions_lock = threading.Lock()
+
+
+# Return a keep-alive session shared by every request with the same pool and retry settings
+def get_http_session(pool_size: int = 10, retries: int = 2, backoff_factor: float = 0.5) -> requests.Session:
+    key = (pool_size, retries, backoff_factor)
+
+    with _sessions_lock:
+        session = _sessions.get(key)
+        if session is None:
+            # Retry refused connections and gateway errors, never a read that timed out mid generation
+            retry = Retry(
+                total=retries,
+                connect=retries,
+                read=0,
+                status=retries,
+                status_forcelist=(502, 503, 504),
+                allowed_methods=frozenset({"GET", "POST"}),
+                backoff_factor=backoff_factor,
+                raise_on_status=False
+            )
+            adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size, max_retries=retry)
+
+            session = requests.Session()
+            session.mount("http://", adapter)
+            session.mount("https://", adapter)
+            _sessions[key] = session
+
+    return session
+
+
+# Close every shared session
+def close_http_sessions() -> None:
+    with _sessions_lock:
+        for session in _sessions.values():
+            session.close()
+        _sessions.clear()
@@ -1,11 +1,14 @@
 from pydantic import BaseModel
 import yaml
-from angle_emb import AnglE, Prompts
-from transformers import AutoModelForSequenceClassification, AutoTokenizer
 import numpy as np
-import requests
 import torch
 import json
+import hashlib
+import asyncio
+from typing import Iterator
+from .model_registry import model_registry, EMBEDDING_MODEL, EMBEDDING_PROMPT, EMBEDDING_POOLING
+from .embedding_cache import get_query_cache
+from .http_client import get_http_session
 
 
 # Data model for a single string to make an embedding result
@@ -36,6 +39,7 @@ class OllamaLLM:
         url (str): The URL of the language model API endpoint. Default is "http://localhost:11434/api/generate".
         temperature (int): The temperature value to be used in the generation process. Default is 0.
         stream (bool): A flag indicating if the response should be streamed or not. Default is False.
+        timeout (tuple[float, float]): The connect and read timeouts in seconds for requests to the API.
 
     Methods:
         chat_request(prompt_in: str, context: str, content_gen: bool) -> str:
@@ -48,6 +52,12 @@ class OllamaLLM:
 
             Returns:
                 str: The response generated by the language model API.
+
+        async_chat_request(prompt_in: str, context: str, content_gen: bool) -> str:
+            Asynchronous version of chat_request.
+
+        stream_chat_request(prompt_in: str, context: str, content_gen: bool) -> Iterator[str]:
+            Makes a streaming chat request and yields the response tokens as the language model generates them.
     """
 
     def __init__(self, config_file):
@@ -57,9 +67,14 @@ class OllamaLLM:
         self.url = data_loaded["ollama_api_url"]
         self.stream = data_loaded["stream"]
         self.temperature = data_loaded["temperature"]
+        self.timeout = (float(data_loaded.get("ollama_connect_timeout", 5)), float(data_loaded.get("ollama_read_timeout", 300)))
+        self._session = get_http_session(
+            pool_size=int(data_loaded.get("ollama_pool_size", 10)),
+            retries=int(data_loaded.get("ollama_retries", 2))
+        )
         self.system = "You use primarily the supplied information to answer question or query. If there isn't enough information supplied to properly answer the question, say you don't know the answer."
 
-    def chat_request(self, prompt_in: str, context: str, content_gen: bool) -> str:
+    def _make_prompt_data(self, prompt_in: str, context: str, content_gen: bool, stream: bool) -> PromptData:
         # Select a prompt based on question answering or content generation
         if content_gen:
             prompt = f"You are an assistant for generating short form content addressing the problem. You use the retrieved context to generate short form content addressing the problem.\nGenerate content that addresses the problem: {prompt_in}\nUsing the following retrieved context: {context}.\nAnswer:"
@@ -67,19 +82,52 @@ class OllamaLLM:
             prompt = f"You are an assistant for question-answering tasks. Use the following pieces of retrieved context to answer the question. If you don't know the answer, just say that you don't know. Use three sentences maximum and keep the answer concise.\nQuestion: {prompt_in}\nContext: {context}.\nAnswer:"
 
         # Data model for entry into LLM
-        data_in = PromptData(
+        return PromptData(
             model=self.model,
-            stream=self.stream,
+            stream=stream,
             prompt=prompt,
             system=self.system,
             temperature=self.temperature
         )
 
+    def chat_request(self, prompt_in: str, context: str, content_gen: bool) -> str:
+        # A streamed response is NDJSON, so collect the tokens instead of parsing the body as one object
+        if self.stream:
+            return "".join(self.stream_chat_request(prompt_in, context, content_gen))
+
+        data_in = self._make_prompt_data(prompt_in, context, content_gen, stream=False)
+
         # LLM post request
-        response = requests.post(self.url, json=data_in.model_dump())
+        response = self._session.post(self.url, json=data_in.model_dump(), timeout=self.timeout)
+        response.raise_for_status()
 
         return json.loads(response.text)["response"]
 
+    async def async_chat_request(self, prompt_in: str, context: str, content_gen: bool) -> str:
+        # Run on a worker thread so several generations can share the pooled session concurrently
+        return await asyncio.to_thread(self.chat_request, prompt_in, context, content_gen)
+
+    def stream_chat_request(self, prompt_in: str, context: str, content_gen: bool) -> Iterator[str]:
+        data_in = self._make_prompt_data(prompt_in, context, content_gen, stream=True)
+
+        # Ollama sends one JSON object per line until the final object with done set
+        with self._session.post(self.url, json=data_in.model_dump(), stream=True, timeout=self.timeout) as response:
+            response.raise_for_status()
+
+            for line in response.iter_lines():
+                if not line:
+                    continue
+
+                chunk = json.loads(line)
+                if "error" in chunk:
+                    raise ValueError(f"Ollama error: {chunk['error']}")
+
+                if chunk.get("response"):
+                    yield chunk["response"]
+
+                if chunk.get("done"):
+                    break
+
 
 class EmbeddingClass:
     """
@@ -89,11 +137,23 @@ class EmbeddingClass:
 
     Methods:
         - __init__(): Initialize the EmbeddingClass object and load the pre-trained model.
-        - batch_embedding(prompt_batch: list) -> list: Embeds a batch of prompts using the pre-trained model.
-        - return_embedding(prompt: str) -> list: Embeds a single prompt using the pre-trained model.
+        - batch_embedding(prompt_batch: list, cache=None) -> list: Embeds a batch of prompts using the pre-trained
+          model. With a cache (see EmbeddingCacheDB) only the prompts missing from it are embedded.
+          Prompts are sorted by token length and packed into batches of at most embedding_token_budget padded tokens
+          (and embedding_batches prompts), the embeddings are returned in the original order.
+        - chunk_key(text: str) -> str: Returns the content hash used to cache the embedding of a chunk.
+        - return_embedding(prompt: str) -> list: Embeds a single prompt using the pre-trained model, served from the
+          query embedding cache when the same query was embedded recently.
+        - query_cache_stats() -> dict: Returns the hit and miss counters of the query embedding cache.
 
     Attributes:
-        - _model: The pre-trained model used for embedding.
+        - _model: The embedding backend (torch, int8 or onnx) shared through the model registry.
+        - _query_cache: The process-wide query embedding cache, None when disabled.
+        - model_id: Identifies the model, pooling, prompt and backend so cached embeddings are never mixed between
+          models or between the torch, int8 and onnx runs of the same model.
+        - last_padding_efficiency: Share of real tokens among the padded tokens of the last length-aware batching.
+        - real_tokens, padded_tokens: Real and padded token counts of every length-aware batching so far, their ratio
+          is the padding efficiency over a whole ingest.
 
     """
 
@@ -101,29 +161,127 @@ class EmbeddingClass:
         with open(config_file, 'r') as stream:
             data_loaded = yaml.safe_load(stream)
         self._batch_size = data_loaded["embedding_batches"]
-        self._model = AnglE.from_pretrained('WhereIsAI/UAE-Large-V1', pooling_strategy='cls').cuda()
-        self._model.set_prompt(prompt=Prompts.C)
+        self._token_budget = int(data_loaded.get("embedding_token_budget", 16384))
+        self.last_padding_efficiency = None
+        self.real_tokens = 0
+        self.padded_tokens = 0
+        self._model = model_registry.get_embedding_model(
+            device=data_loaded.get("embedding_device", "auto"),
+            backend=data_loaded.get("embedding_backend", "auto"),
+            num_threads=int(data_loaded.get("embedding_threads", 0))
+        )
+        # The backend name carries its precision (torch and onnx run fp32, int8 is quantized), their outputs differ
+        self.model_id = f"{EMBEDDING_MODEL}|{EMBEDDING_POOLING}|{EMBEDDING_PROMPT}|{self._model.name}"
+
+        # Repeated queries skip the forward pass, a size of 0 disables the cache
+        self._query_cache = None
+        if int(data_loaded.get("query_cache_size", 1024)) > 0:
+            self._query_cache = get_query_cache(
+                int(data_loaded.get("query_cache_size", 1024)),
+                float(data_loaded.get("query_cache_ttl", 3600)),
+                data_loaded.get("query_cache_path") or None
+            )
+
+    def chunk_key(self, text: str) -> str:
+        return hashlib.sha256(f"{self.model_id}\0{text}".encode("utf-8")).hexdigest()
+
+    def _token_lengths(self, prompt_batch: list) -> list:
+        texts = [EMBEDDING_PROMPT.format(**item) for item in prompt_batch]
+        tokens = self._model.tokenizer(texts, add_special_tokens=True, truncation=True, max_length=512)
+
+        return [len(input_ids) for input_ids in tokens["input_ids"]]
+
+    def _make_batches(self, prompt_batch: list) -> list:
+        # Fixed slices in document order when length-aware batching is off
+        if self._token_budget <= 0:
+            return [list(range(i, min(i + self._batch_size, len(prompt_batch)))) for i in range(0, len(prompt_batch), self._batch_size)]
+
+        # Longest first so each batch is padded to its first member, then pack under the token budget
+        lengths = self._token_lengths(prompt_batch)
+        order = sorted(range(len(prompt_batch)), key=lambda idx: lengths[idx], reverse=True)
+
+        batches = []
+        current = []
+        for idx in order:
+            padded_size = (len(current) + 1) * lengths[current[0] if current else idx]
+            if current and (padded_size > self._token_budget or len(current) >= self._batch_size):
+                batches.append(current)
+                current = []
+            current.append(idx)
+
+        if current:
+            batches.append(current)
+
+        real_tokens = sum(lengths)
+        padded_tokens = sum(len(batch) * lengths[batch[0]] for batch in batches)
+        self.last_padding_efficiency = real_tokens / padded_tokens if padded_tokens else 1.0
+        self.real_tokens += real_tokens
+        self.padded_tokens += padded_tokens
+
+        return batches
+
+    def _encode_batches(self, prompt_batch: list) -> list:
+        batch_encodings = [None] * len(prompt_batch)
+
+        # Process each batch and put the results back in the original order
+        for batch in self._make_batches(prompt_batch):
+            data_in = BatchEmbModel(prompt_batch=[prompt_batch[idx] for idx in batch])
+            chunk_encoding = self._model.encode(data_in.prompt_batch, to_numpy=True)
+            chunk_encoding = chunk_encoding.tolist()
+            for idx, encoding in zip(batch, chunk_encoding):
+                batch_encodings[idx] = encoding
+
+        return batch_encodings
+
+    def batch_embedding(self, prompt_batch: list, cache=None) -> list:
+        if not prompt_batch:
+            return []
+
+        if cache is None:
+            return self._encode_batches(prompt_batch)
 
-    def batch_embedding(self, prompt_batch: list) -> list:
-        # Split the prompt_batch into batches of 64 entries into embedding
-        prompt_chunks = [prompt_batch[i:i + self._batch_size] for i in range(0, len(prompt_batch), self._batch_size)]
+        # Only embed the chunks missing from the cache, then splice the cached vectors back in order
+        cache_keys = [self.chunk_key(item["text"]) for item in prompt_batch]
+        cached = cache.get_many(list(set(cache_keys)))
+        missing = {}
+        for idx, cache_key in enumerate(cache_keys):
+            if cache_key not in cached and cache_key not in missing:
+                missing[cache_key] = idx
 
-        # Process each chunk and accumulate the results
+        new_encodings = self._encode_batches([prompt_batch[idx] for idx in missing.values()])
+        cache.add_many([(cache_key, self.model_id, encoding) for cache_key, encoding in zip(missing.keys(), new_encodings)])
+
+        computed = dict(zip(missing.keys(), new_encodings))
         batch_encodings = []
-        for chunk in prompt_chunks:
-            data_in = BatchEmbModel(prompt_batch=chunk)
-            chunk_encoding = self._model.encode(data_in.prompt_batch, to_numpy=True)
-            chunk_encoding = chunk_encoding.tolist()
-            batch_encodings.extend(chunk_encoding)
+        for cache_key in cache_keys:
+            if cache_key in computed:
+                batch_encodings.append(computed[cache_key])
+            else:
+                batch_encodings.append(cached[cache_key].tolist())
 
         return batch_encodings
 
     def return_embedding(self, prompt: str) -> list:
         data_in = EmbDataModel(prompt=prompt)
-        embedding = self._model.encode({"text": data_in.prompt}, to_numpy=True)[0]
+
+        if self._query_cache is None:
+            return self._model.encode({"text": data_in.prompt}, to_numpy=True)[0]
+
+        cache_key = self._query_cache.make_key(data_in.prompt, self.model_id)
+        embedding = self._query_cache.get(cache_key)
+
+        if embedding is None:
+            embedding = self._model.encode({"text": data_in.prompt}, to_numpy=True)[0]
+            self._query_cache.put(cache_key, embedding)
 
         return embedding
 
+    def query_cache_stats(self) -> dict:
+        if self._query_cache is None:
+            return {}
+
+        return self._query_cache.stats()
+
 
 class EmbeddingReranker:
     """
@@ -131,37 +289,72 @@ class EmbeddingReranker:
 
     Attributes:
         _tokenizer (AutoTokenizer): The tokenizer used for encoding text inputs.
-        _model (AutoModelForSequenceClassification): The model used for reranking.
+        _model (AutoModelForSequenceClassification): The model used for reranking, shared through the model registry.
         _device (torch.device): The device used for running the model (GPU or CPU).
+        _batch_size (int): The number of (query, source) pairs scored per forward pass.
 
     Methods:
-        rerank_data(data_in: RerankDataModel) -> list:
+        rerank_data(query: str, sources: list, top_k: int = None) -> list:
             Re-ranks a list of sources based on a given query.
 
+        rerank_with_scores(query: str, sources: list, top_k: int = None) -> tuple[list, list]:
+            Re-ranks a list of sources and returns the sources with their scores, best first. With top_k only the
+            best top_k sources are returned.
+
     """
 
-    def __init__(self):
-        self._tokenizer = AutoTokenizer.from_pretrained('BAAI/bge-reranker-large')
-        self._model = AutoModelForSequenceClassification.from_pretrained('BAAI/bge-reranker-large')
-        self._device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
-        self._model.to(self._device)
-
-    def rerank_data(self, query: str, sources: list) -> list:
-        # Create pairs for the query
-        pairs = [[query, source] for source in sources]
+    def __init__(self, config_file=None):
+        device = "auto"
+        precision = "fp32"
+        self._batch_size = 16
+        if config_file is not None:
+            with open(config_file, 'r') as stream:
+                data_loaded = yaml.safe_load(stream)
+            device = data_loaded.get("reranker_device", "auto")
+            precision = data_loaded.get("reranker_precision", "fp32")
+            self._batch_size = int(data_loaded.get("rerank_batch_size", 16))
+
+        self._tokenizer, self._model, self._device = model_registry.get_reranker(device=device, precision=precision)
+
+    def _score(self, pairs: list) -> np.ndarray:
+        # Bucket the pairs by token length so each micro-batch pads to a similar length
+        lengths = [len(input_ids) for input_ids in self._tokenizer(pairs, truncation=True, max_length=512)["input_ids"]]
+        order = np.argsort(lengths, kind="stable")
+        scores = np.empty(len(pairs), dtype=np.float32)
 
         # Run the model
-        self._model.eval()
         with torch.no_grad():
-            inputs = self._tokenizer(pairs, padding=True, truncation=True, return_tensors='pt', max_length=512)
-            inputs = inputs.to(self._device)
+            for start in range(0, len(pairs), self._batch_size):
+                batch = order[start:start + self._batch_size]
+                inputs = self._tokenizer([pairs[i] for i in batch], padding=True, truncation=True, return_tensors='pt', max_length=512)
+                inputs = inputs.to(self._device)
+
+                batch_scores = self._model(**inputs, return_dict=True).logits.view(-1, ).float()
+                scores[batch] = batch_scores.cpu().numpy()
+
+        return scores
+
+    def rerank_with_scores(self, query: str, sources: list, top_k: int = None) -> tuple[list, list]:
+        if not sources:
+            return [], []
+
+        # Create pairs for the query
+        pairs = [[query, source] for source in sources]
+        scores = self._score(pairs)
 
-            scores = self._model(**inputs, return_dict=True).logits.view(-1, ).float()
-            scores = scores.cpu().numpy()
+        # Select the top k without sorting every score, then sort the selection
+        if top_k is not None and 0 < top_k < len(sources):
+            top_index = np.argpartition(-scores, top_k - 1)[:top_k]
+        else:
+            top_index = np.arange(len(sources))
 
-        # Sort the sources
-        sorted_index_sources = np.argsort(scores).tolist()
-        sorted_index_sources = sorted_index_sources[::-1]
+        sorted_index_sources = top_index[np.argsort(-scores[top_index], kind="stable")].tolist()
         sorted_sources = [sources[i] for i in sorted_index_sources]
+        sorted_scores = [float(scores[i]) for i in sorted_index_sources]
+
+        return sorted_sources, sorted_scores
+
+    def rerank_data(self, query: str, sources: list, top_k: int = None) -> list:
+        sorted_sources, _ = self.rerank_with_scores(query, sources, top_k)
 
         return sorted_sources
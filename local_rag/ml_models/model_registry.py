@@ -0,0 +1,124 @@
+import threading
+import torch
+from angle_emb import Prompts
+from transformers import AutoModelForSequenceClassification, AutoTokenizer
+from .embedding_backends import EMBEDDING_BACKENDS, TorchEmbeddingBackend, resolve_backend
+
+
+EMBEDDING_MODEL = 'WhereIsAI/UAE-Large-V1'
+RERANKER_MODEL = 'BAAI/bge-reranker-large'
+EMBEDDING_PROMPT = Prompts.C
+EMBEDDING_POOLING = 'cls'
+
+
+def resolve_device(device: str = "auto") -> str:
+    # "auto" (or an empty setting) picks the GPU when one is available
+    if device is None or device == "" or device == "auto":
+        return "cuda" if torch.cuda.is_available() else "cpu"
+
+    return device
+
+
+class ModelRegistry:
+    """
+    ModelRegistry
+
+    Process-wide store for the transformer models used by Local Rag. Each model is loaded lazily the first time it
+    is requested and then shared by every EmbeddingClass and EmbeddingReranker instance in the process.
+
+    Methods:
+        get_embedding_model(model_name: str, device: str, backend: str, num_threads: int) -> TorchEmbeddingBackend:
+            Returns the embedding backend (torch, int8 or onnx), loading it on first use.
+
+        get_reranker(model_name: str, device: str, precision: str) -> tuple[AutoTokenizer, AutoModelForSequenceClassification, torch.device]:
+            Returns the tokenizer, model and device of the re-ranker in fp32, bf16 or int8, loading it on first use.
+
+        warmup(embedding_device: str, reranker_device: str, embedding_backend: str, reranker_precision: str,
+               embedding_threads: int) -> None:
+            Loads the embedding and re-ranker models ahead of the first request.
+
+        unload(kind: str) -> None:
+            Drops the loaded models of a kind ("embedding" or "reranker"), or all models when kind is None.
+
+        loaded() -> list[tuple]:
+            Returns the (kind, model name, device, ...) key of every loaded model.
+    """
+
+    def __init__(self):
+        self._models = {}
+        self._lock = threading.Lock()
+        self._load_locks = {}
+
+    def _get_or_load(self, key: tuple, loader):
+        model = self._models.get(key)
+        if model is not None:
+            return model
+
+        # One lock per model so a slow load doesn't block lookups of other models
+        with self._lock:
+            load_lock = self._load_locks.setdefault(key, threading.Lock())
+
+        with load_lock:
+            model = self._models.get(key)
+            if model is None:
+                model = loader()
+                self._models[key] = model
+
+        return model
+
+    def get_embedding_model(self, model_name: str = EMBEDDING_MODEL, device: str = "auto", backend: str = "auto",
+                            num_threads: int = 0):
+        backend = resolve_backend(backend)
+        # The quantized and ONNX backends only run on the CPU
+        device = resolve_device(device) if backend == TorchEmbeddingBackend.name else "cpu"
+
+        def _load():
+            return EMBEDDING_BACKENDS[backend](model_name, device, EMBEDDING_PROMPT, EMBEDDING_POOLING, num_threads)
+
+        # The thread count is part of the key, a model loaded by warmup must not keep a different one
+        return self._get_or_load(("embedding", model_name, device, backend, num_threads), _load)
+
+    def get_reranker(self, model_name: str = RERANKER_MODEL, device: str = "auto", precision: str = "fp32") -> tuple:
+        if precision not in ("fp32", "bf16", "int8"):
+            raise ValueError(f"Unknown reranker precision {precision}, choose one of fp32, bf16 or int8.")
+
+        # Dynamic int8 quantization only runs on the CPU
+        device = resolve_device(device) if precision != "int8" else "cpu"
+
+        def _load():
+            tokenizer = AutoTokenizer.from_pretrained(model_name)
+            model = AutoModelForSequenceClassification.from_pretrained(model_name)
+            torch_device = torch.device(device)
+
+            if precision == "bf16":
+                model = model.to(torch.bfloat16)
+            elif precision == "int8":
+                model = torch.quantization.quantize_dynamic(model, {torch.nn.Linear}, dtype=torch.qint8)
+
+            model.to(torch_device)
+            model.eval()
+            return tokenizer, model, torch_device
+
+        return self._get_or_load(("reranker", model_name, device, precision), _load)
+
+    def warmup(self, embedding_device: str = "auto", reranker_device: str = "auto", embedding_backend: str = "auto",
+               reranker_precision: str = "fp32", embedding_threads: int = 0) -> None:
+        self.get_embedding_model(device=embedding_device, backend=embedding_backend, num_threads=embedding_threads)
+        self.get_reranker(device=reranker_device, precision=reranker_precision)
+
+    def unload(self, kind: str = None) -> None:
+        with self._lock:
+            for key in list(self._models.keys()):
+                if kind is None or key[0] == kind:
+                    del self._models[key]
+                    self._load_locks.pop(key, None)
+
+        if torch.cuda.is_available():
+            torch.cuda.empty_cache()
+
+    def loaded(self) -> list[tuple]:
+        return list(self._models.keys())
+
+
+# Shared by the whole process
+model_registry = ModelRegistry()
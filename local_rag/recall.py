@@ -0,0 +1,69 @@
+import argparse
+import time
+import numpy as np
+from .database import DocumentDB, get_vector_database
+from .migrate import default_config_file
+
+
+# Fraction of the exact top k that the approximate search returns, with the mean latency of both in milliseconds
+def measure_recall(vec_db, queries: np.ndarray, k: int) -> dict:
+    recalls = []
+    search_seconds = 0.0
+    exact_seconds = 0.0
+
+    for query in queries:
+        start = time.perf_counter()
+        approximate = vec_db.get_matches(query, k)
+        search_seconds += time.perf_counter() - start
+
+        start = time.perf_counter()
+        exact = vec_db.exact_matches(query, k)
+        exact_seconds += time.perf_counter() - start
+
+        if exact:
+            recalls.append(len({d[0] for d in approximate} & {d[0] for d in exact}) / len(exact))
+
+    n = max(len(queries), 1)
+    return {
+        "queries": len(queries),
+        "recall": float(np.mean(recalls)) if recalls else 0.0,
+        "search_ms": 1000 * search_seconds / n,
+        "exact_ms": 1000 * exact_seconds / n,
+    }
+
+
+def main(argv=None) -> None:
+    parser = argparse.ArgumentParser(prog="python -m local_rag.recall",
+                                     description="Measure the recall@k of the vector search of a document store against exact search.")
+    parser.add_argument("--store", required=True, help="Name of the document store.")
+    parser.add_argument("--k", type=int, default=10)
+    parser.add_argument("--n", type=int, default=100, help="Number of queries.")
+    parser.add_argument("--queries", default=None,
+                        help="File with one question per line, defaults to stored vectors picked at random.")
+    parser.add_argument("--config", default=default_config_file(), help="Path to the yaml config file.")
+    args = parser.parse_args(argv)
+
+    document = DocumentDB(args.config).get_doc_by_name(args.store)
+    if document is None:
+        raise SystemExit(f"No document store named {args.store}")
+
+    vec_db = get_vector_database(args.config, document[0])
+    if args.queries:
+        # Imported here so sampling stored vectors doesn't load the embedding model
+        from .ml_models import EmbeddingClass
+
+        with open(args.queries, 'r') as file:
+            questions = [line.strip() for line in file if line.strip()][:args.n]
+        embedding_class = EmbeddingClass(args.config)
+        queries = np.array([embedding_class.return_embedding(question) for question in questions], dtype=np.float32)
+    else:
+        queries = vec_db.sample_vectors(args.n)
+
+    stats = measure_recall(vec_db, queries, args.k)
+    print(f"{args.store}: recall@{args.k} {stats['recall']:.3f} over {stats['queries']} queries, "
+          f"{stats['search_ms']:.2f} ms per search, {stats['exact_ms']:.2f} ms per exact search "
+          f"(vector_quantization {getattr(vec_db, 'quantization', 'none')})")
+
+
+if __name__ == "__main__":
+    main()
@@ -69,34 +69,38 @@ if check_yaml_population(config_file, required_keys):
         query = st.button("Generate Content")
 
         if query:
-            with st.status("Answering query...", expanded=True) as status:
-                # Reranking strategy and setting K depending on it
-                st.write("Searching for results...")
-                if rank_strategy == "rerank":
-                    paragraph_id_list, cosine_results = rag_class.retrieve_documents(content_query, k*4, selected_pdf_id)
-                else:
-                    paragraph_id_list, cosine_results = rag_class.retrieve_documents(content_query, k, selected_pdf_id)
-
-                # Getting sources
-                st.write("Searching for sources...")
-                sources_list = rag_class.get_paragraph_sources(paragraph_id_list)
-
-                # Reranking strategy
-                if rank_strategy == "rerank":
-                    st.write("Re-ranking sources...")
-                    sorted_sources = rag_class.rerank_sources(content_query, sources_list)
-                    sorted_sources = sorted_sources[:k]
-                    context_for_llm = "".join(sorted_sources)
-                else:
-                    sorted_sources = sources_list
-                    context_for_llm = "".join(sources_list)
-
-                # Send to LLM
-                st.write("Sending to AI...")
-                answer = rag_class.make_llm_request(content_query, context_for_llm, gen_content=True)
-                status.update(label="Answer found!", state="complete", expanded=False)
-
-            st.markdown(answer)
+            # A close enough earlier request on the same store and settings is answered from the cache
+            cached = rag_class.lookup_answer(content_query, selected_pdf_id, k, rank_strategy, gen_content=True)
+
+            if cached is not None:
+                answer, sorted_sources = cached
+                st.markdown(answer)
+            else:
+                with st.status("Answering query...", expanded=True) as status:
+                    # Reranking strategy and setting K depending on it
+                    st.write("Searching for results...")
+                    if rank_strategy == "rerank":
+                        paragraph_id_list, cosine_results, sources_list = rag_class.retrieve_documents(content_query, k * 4, selected_pdf_id, return_sources=True)
+                    else:
+                        paragraph_id_list, cosine_results, sources_list = rag_class.retrieve_documents(content_query, k, selected_pdf_id, return_sources=True)
+
+                    # Reranking strategy
+                    if rank_strategy == "rerank":
+                        st.write("Re-ranking sources...")
+                        sorted_sources = rag_class.rerank_sources(content_query, sources_list, top_k=k)
+                        context_for_llm = rag_class.build_context(sorted_sources)
+                    else:
+                        sorted_sources = sources_list
+                        context_for_llm = rag_class.build_context(sources_list)
+
+                    # Send to LLM
+                    st.write("Sending to AI...")
+                    status.update(label="Sources found!", state="complete", expanded=False)
+
+                # Show the content as the tokens arrive
+                answer = st.write_stream(rag_class.stream_llm_request(content_query, context_for_llm, gen_content=True))
+
+                rag_class.store_answer(content_query, selected_pdf_id, k, rank_strategy, answer, sorted_sources, gen_content=True)
 
             for idx, item in enumerate(sorted_sources):
                 with st.expander(f"Source {idx + 1}"):
@@ -43,6 +43,14 @@ def check_yaml_population(yaml_file, required_keys):
         return False
 
 
+# Uploaded file types and the matching reader
+file_types = {
+    "application/pdf": "pdf",
+    "text/plain": "txt",
+    "application/vnd.openxmlformats-officedocument.wordprocessingml.document": "docx"
+}
+
+
 # Page setup
 st.set_page_config(page_title="Document Manager")
 st.title("Document Manager")
@@ -79,21 +87,11 @@ if check_yaml_population(config_file, required_keys):
                 st.write("Uploading file...")
                 save_uploaded_file(file_directory, uploaded_file)
 
-                st.write("Breaking up document...")
-                if uploaded_file.type == "application/pdf":
-                    list_to_embed, paragraph_keys, doc_id = rag_class.pdf_document_reader(uploaded_file.name, name_in_db, chunk_strategy=chunk_strategy)
-
-                elif uploaded_file.type == "text/plain":
-                    list_to_embed, paragraph_keys, doc_id = rag_class.txt_document_reader(uploaded_file.name, name_in_db, chunk_strategy=chunk_strategy)
-
-                elif uploaded_file.type == "application/vnd.openxmlformats-officedocument.wordprocessingml.document":
-                    list_to_embed, paragraph_keys, doc_id = rag_class.docx_document_reader(uploaded_file.name, name_in_db, chunk_strategy=chunk_strategy)
-
-                st.write("Generating vectors...")
-                embeddings = rag_class.create_batch_embeddings(list_to_embed, doc_id)
-
-                st.write("Adding vectors into vector database...")
-                rag_class.load_documents_db(embeddings, paragraph_keys, doc_id)
+                # Pages are chunked, embedded and stored as they are read
+                st.write("Breaking up document and generating vectors...")
+                progress_text = st.empty()
+                rag_class.ingest_document(file_types[uploaded_file.type], uploaded_file.name, name_in_db, chunk_strategy,
+                                          on_progress=lambda stats: progress_text.write(f"Stored {stats['chunks']} chunks..."))
 
                 st.write("Cleaning up...")
                 os.remove(os.path.join(file_directory, uploaded_file.name))
@@ -152,21 +150,11 @@ if check_yaml_population(config_file, required_keys):
                     st.write("Uploading file...")
                     save_uploaded_file(file_directory, add_uploaded_file)
 
-                    st.write("Breaking up document...")
-                    if add_uploaded_file.type == "application/pdf":
-                        list_to_embed, paragraph_keys, _ = rag_class.pdf_document_reader(add_uploaded_file.name, add_document_name, chunk_strategy=add_chunk_strategy, add_to_doc=True)
-
-                    elif add_uploaded_file.type == "text/plain":
-                        list_to_embed, paragraph_keys, _ = rag_class.txt_document_reader(add_uploaded_file.name, name_in_db, chunk_strategy=add_chunk_strategy, add_to_doc=True)
-
-                    elif add_uploaded_file.type == "application/vnd.openxmlformats-officedocument.wordprocessingml.document":
-                        list_to_embed, paragraph_keys, _ = rag_class.docx_document_reader(add_uploaded_file.name, name_in_db, chunk_strategy=add_chunk_strategy, add_to_doc=True)
-
-                    st.write("Generating vectors...")
-                    embeddings = rag_class.create_batch_embeddings(list_to_embed, add_pdf_id)
-
-                    st.write("Adding vectors into vector database...")
-                    rag_class.load_documents_db(embeddings, paragraph_keys, add_pdf_id)
+                    # Pages are chunked, embedded and stored as they are read
+                    st.write("Breaking up document and generating vectors...")
+                    progress_text = st.empty()
+                    rag_class.ingest_document(file_types[add_uploaded_file.type], add_uploaded_file.name, add_document_name, add_chunk_strategy,
+                                              doc_id=add_pdf_id, on_progress=lambda stats: progress_text.write(f"Stored {stats['chunks']} chunks..."))
 
                     st.write("Cleaning up...")
                     os.remove(os.path.join(file_directory, add_uploaded_file.name))
@@ -17,9 +17,21 @@ def display_settings(settings):
     db_settings = {}
     model_settings = {}
     not_display_settings = {}
-    settings_not_display = ["doc_text_table", "paragraph_table", "vector_dim", "temp_doc_storage", "stream"]
+    settings_not_display = ["doc_text_table", "paragraph_table", "vector_dim", "temp_doc_storage", "stream",
+                            "embedding_device", "reranker_device", "embedding_backend", "embedding_threads",
+                            "db_pool_min", "db_pool_max", "db_pool_timeout", "db_pool_ping_interval",
+                            "ollama_connect_timeout", "ollama_read_timeout", "ollama_retries", "ollama_pool_size",
+                            "query_cache_size", "query_cache_ttl", "query_cache_path", "embedding_cache_table",
+                            "embedding_cache", "search_workers", "index_build_mode", "hnsw_m",
+                            "hnsw_ef_construction", "embedding_token_budget", "reranker_precision",
+                            "rerank_batch_size", "ingest_batch_size", "ingest_queue_size", "extraction_workers",
+                            "extraction_shard_pages", "db_write_batch_size", "id_scheme", "rrf_k",
+                            "hybrid_oversample", "vector_backend", "local_vector_path", "local_vector_dtype",
+                            "local_hnsw_threshold", "local_hnsw_ef_search", "vector_quantization",
+                            "rescore_oversample", "binary_oversample", "answer_cache_size", "answer_cache_ttl",
+                            "answer_cache_threshold", "context_token_budget", "text_storage", "sentence_window"]
     db_settings_list = ["database_name", "db_port", "host", "user", "password"]
-    model_settings_list = ["model_name", "ollama_api_url", "embedding_batches", "temperature"]
+    model_settings_list = ["model_name", "ollama_api_url", "embedding_batches", "temperature", "retrieval_mode"]
 
     # Split settings into categories
     for key, value in settings.items():
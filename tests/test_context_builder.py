@@ -0,0 +1,44 @@
+from local_rag.context_builder import ContextBuilder, estimate_tokens
+
+
+def words(prefix: str, n: int) -> str:
+    return " ".join(f"{prefix}{x}" for x in range(n))
+
+
+def test_top_ranked_source_survives_truncation():
+    # Five ~400 token sources, best first, under a budget that holds about four of them
+    sources = [words(name, 400) for name in "abcde"]
+    context = ContextBuilder(1536).build(sources)
+
+    assert context.startswith(sources[0])
+    assert sources[1] in context
+    assert "e0" not in context.split()
+    assert estimate_tokens(context) <= 1536
+
+
+def test_last_span_is_cut_at_a_word_boundary():
+    sources = [words("a", 100), words("b", 100)]
+    context = ContextBuilder(estimate_tokens(sources[0]) + 20).build(sources)
+    last = context.split("\n\n")[-1].split()
+
+    assert context.startswith(sources[0])
+    assert last and all(word.startswith("b") for word in last)
+    assert last == sources[1].split()[:len(last)]
+
+
+def test_overlapping_sources_merge_at_the_best_rank():
+    shared = words("s", 10)
+    best = f"{words('a', 5)} {shared}"
+    middle = words("m", 20)
+    worst = f"{shared} {words('z', 5)}"
+
+    spans = ContextBuilder().merge([best, middle, worst])
+
+    assert spans == [f"{best} {words('z', 5)}", middle]
+
+
+def test_contained_source_is_dropped():
+    outer = words("w", 30)
+    inner = " ".join(outer.split()[5:20])
+
+    assert ContextBuilder().merge([inner, outer]) == [outer]
@@ -0,0 +1,173 @@
+import asyncio
+import json
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import pytest
+import yaml
+
+ml_models = pytest.importorskip("local_rag.ml_models", reason="needs the packages in requirements.txt")
+requests = pytest.importorskip("requests")
+
+
+class FakeOllama(ThreadingHTTPServer):
+    """
+    Local stand-in for the Ollama generate endpoint. Answers with one JSON object, or NDJSON lines when the request
+    streams, after delay seconds. The first fail_times requests get a 503. Counts connections, requests and the most
+    requests handled at once.
+    """
+    daemon_threads = True
+
+    def __init__(self):
+        super().__init__(("127.0.0.1", 0), FakeOllamaHandler)
+        self.delay = 0.0
+        self.fail_times = 0
+        self.connections = 0
+        self.requests = 0
+        self.in_flight = 0
+        self.max_in_flight = 0
+        self.lock = threading.Lock()
+
+    @property
+    def url(self) -> str:
+        return f"http://127.0.0.1:{self.server_address[1]}/api/generate"
+
+
+class FakeOllamaHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def setup(self):
+        super().setup()
+        with self.server.lock:
+            self.server.connections += 1
+
+    def log_message(self, format, *args):
+        pass
+
+    def _send(self, status: int, body: bytes, content_type: str) -> None:
+        self.send_response(status)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_POST(self):
+        data_in = json.loads(self.rfile.read(int(self.headers["Content-Length"])))
+
+        with self.server.lock:
+            self.server.requests += 1
+            fail = self.server.requests <= self.server.fail_times
+            self.server.in_flight += 1
+            self.server.max_in_flight = max(self.server.max_in_flight, self.server.in_flight)
+
+        try:
+            time.sleep(self.server.delay)
+            if fail:
+                self._send(503, b'{"error": "busy"}', "application/json")
+            elif data_in["stream"]:
+                lines = [{"response": token, "done": False} for token in ("Local", " ", "RAG")] + [{"response": "", "done": True}]
+                self._send(200, "".join(json.dumps(line) + "\n" for line in lines).encode(), "application/x-ndjson")
+            else:
+                self._send(200, json.dumps({"response": f"echo {data_in['model']}", "done": True}).encode(), "application/json")
+        finally:
+            with self.server.lock:
+                self.server.in_flight -= 1
+
+
+@pytest.fixture
+def server():
+    fake = FakeOllama()
+    thread = threading.Thread(target=fake.serve_forever, daemon=True)
+    thread.start()
+    yield fake
+    fake.shutdown()
+    fake.server_close()
+    ml_models.close_http_sessions()
+
+
+def make_llm(tmp_path, url: str, **settings):
+    config = {"model_name": "mistral", "ollama_api_url": url, "stream": False, "temperature": 0,
+              "ollama_connect_timeout": 2, "ollama_read_timeout": 5, "ollama_retries": 2, "ollama_pool_size": 10,
+              **settings}
+    config_file = tmp_path / "config.yaml"
+    config_file.write_text(yaml.safe_dump(config))
+
+    return ml_models.OllamaLLM(str(config_file))
+
+
+def test_chat_request_reuses_the_connection(server, tmp_path):
+    llm = make_llm(tmp_path, server.url)
+
+    answers = [llm.chat_request("question", "context", False) for _ in range(3)]
+
+    assert answers == ["echo mistral"] * 3
+    assert server.requests == 3
+    assert server.connections == 1
+
+
+def test_streamed_response_is_collected(server, tmp_path):
+    llm = make_llm(tmp_path, server.url, stream=True)
+
+    assert list(llm.stream_chat_request("question", "context", False)) == ["Local", " ", "RAG"]
+    assert llm.chat_request("question", "context", False) == "Local RAG"
+
+
+def test_timeouts_come_from_the_config(server, tmp_path):
+    llm = make_llm(tmp_path, server.url, ollama_connect_timeout=1.5, ollama_read_timeout=30)
+
+    assert llm.timeout == (1.5, 30.0)
+
+
+def test_read_timeout_is_raised_without_a_retry(server, tmp_path):
+    server.delay = 1.0
+    llm = make_llm(tmp_path, server.url, ollama_read_timeout=0.2)
+
+    start = time.perf_counter()
+    with pytest.raises(requests.exceptions.RequestException):
+        llm.chat_request("question", "context", False)
+
+    assert time.perf_counter() - start < server.delay
+    assert server.requests == 1
+
+
+def test_refused_connection_fails(tmp_path):
+    closed = FakeOllama()
+    url = closed.url
+    closed.server_close()
+    llm = make_llm(tmp_path, url, ollama_retries=0)
+
+    with pytest.raises(requests.exceptions.ConnectionError):
+        llm.chat_request("question", "context", False)
+    ml_models.close_http_sessions()
+
+
+def test_503_is_retried(server, tmp_path):
+    server.fail_times = 2
+    llm = make_llm(tmp_path, server.url, ollama_retries=2)
+
+    assert llm.chat_request("question", "context", False) == "echo mistral"
+    assert server.requests == 3
+
+
+def test_503_after_the_last_retry_is_raised(server, tmp_path):
+    server.fail_times = 3
+    llm = make_llm(tmp_path, server.url, ollama_retries=1)
+
+    with pytest.raises(requests.exceptions.HTTPError):
+        llm.chat_request("question", "context", False)
+    assert server.requests == 2
+
+
+def test_async_chat_requests_run_concurrently(server, tmp_path):
+    server.delay = 0.5
+    llm = make_llm(tmp_path, server.url)
+
+    async def ask_all():
+        return await asyncio.gather(*[llm.async_chat_request(f"question {x}", "context", False) for x in range(4)])
+
+    start = time.perf_counter()
+    answers = asyncio.run(ask_all())
+
+    assert answers == ["echo mistral"] * 4
+    assert server.max_in_flight == 4
+    assert time.perf_counter() - start < 4 * server.delay
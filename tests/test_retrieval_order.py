@@ -0,0 +1,51 @@
+import os
+import pytest
+
+main = pytest.importorskip("local_rag.main", reason="needs the packages in requirements.txt")
+
+CONFIG_FILE = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "config.yaml")
+
+
+class FakeEmbedding:
+    def __init__(self, config_file):
+        pass
+
+    def return_embedding(self, prompt):
+        return [1.0, 0.0]
+
+
+class FakeVectorStore:
+    """Returns matches farthest first, like VectorDatabase.get_matches."""
+
+    distances = {"store_a": [0.1, 0.4, 0.7], "store_b": [0.2, 0.5]}
+
+    def __init__(self, config_file, db_table):
+        self.db_table = db_table
+
+    def get_matches(self, vector_search, n_results):
+        matches = [(f"{self.db_table}_{x}", distance, {"paragraph_id": f"{self.db_table}_{x}"})
+                   for x, distance in enumerate(self.distances[self.db_table])][:n_results]
+        return matches[::-1]
+
+
+@pytest.fixture
+def rag(monkeypatch):
+    monkeypatch.setattr(main, "EmbeddingClass", FakeEmbedding)
+    monkeypatch.setattr(main, "get_vector_database", FakeVectorStore)
+    rag = main.LocalRag(CONFIG_FILE)
+    rag.retrieval_mode = "vector"
+    return rag
+
+
+def test_single_store_is_best_first(rag):
+    paragraph_ids, distances = rag.retrieve_documents("question", 3, "store_a")
+
+    assert paragraph_ids == ["store_a_0", "store_a_1", "store_a_2"]
+    assert distances == sorted(distances)
+
+
+def test_several_stores_are_best_first(rag):
+    paragraph_ids, distances = rag.retrieve_documents_multi("question", 3, ["store_a", "store_b"])
+
+    assert paragraph_ids == ["store_a_0", "store_b_0", "store_a_1"]
+    assert distances == sorted(distances)